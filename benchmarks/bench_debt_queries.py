@@ -0,0 +1,162 @@
+"""Задержка выборок debts/users без индексов, с индексами миграции 1 и со всеми индексами схемы.
+
+    python benchmarks/bench_debt_queries.py [--sizes 10000 100000 1000000] [--repeat 200]
+
+Для каждого размера создается временная база, мигрированная Database.migrate() до последней
+версии, и заполняется случайными долгами и пользователями. Затем индексы debts и users
+удаляются, и запросы замеряются трижды: без индексов, после _create_indexes (миграция 1) и
+после _create_chat_debts_index (миграция 9, постраничный вывод). Запросы те же, что выполняет
+Database: _fetch_pair_debts и _debts_page_query вызываются напрямую, остальные повторяют SQL методов.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tech.database import Database, _create_chat_debts_index, _create_indexes, _debts_page_query, _fetch_pair_debts  # noqa: E402
+
+DEBTS_PER_CHAT = 50
+USERS_PER_CHAT = 10
+# участников в одной трате для _fetch_pair_debts
+SPLIT_SIZE = 4
+PAGE_SIZE = 20
+
+
+def _fetchall(sql, params):
+    return lambda connection, sample: connection.execute(sql, params(sample)).fetchall()
+
+
+def _page(debts_filter, direction):
+    def run(connection, sample):
+        user_id = sample["creditor"] if debts_filter == "creditor" else sample["debtor"]
+        after, before = (sample["debt_id"], None) if direction == "after" else (None, sample["debt_id"])
+        return connection.execute(*_debts_page_query(sample["chat"], debts_filter, user_id, after, before, PAGE_SIZE)).fetchall()
+    return run
+
+
+# (метод Database, функция запроса от (connection, sample))
+QUERIES = [
+    ("apply_expense_split", lambda connection, sample: _fetch_pair_debts(connection, sample["chat"], sample["creditor"], sample["split"])),
+    ("get_debts_from_chat", _fetchall(
+        "SELECT debt_id, debtor_id, creditor_id, amount_minor, currency, date FROM debts WHERE chat_id = ?",
+        lambda sample: (sample["chat"],))),
+    ("get_debts_for_pair", _fetchall(
+        "SELECT debt_id, debtor_id, creditor_id, amount_minor, currency, date FROM debts WHERE chat_id = ? and creditor_id = ? and debtor_id = ? ",
+        lambda sample: (sample["chat"], sample["creditor"], sample["debtor"]))),
+    ("get_debts_by_debtor_id", _fetchall(
+        "SELECT debt_id, debtor_id, creditor_id, amount_minor, currency, date FROM debts WHERE chat_id = ? and debtor_id = ?",
+        lambda sample: (sample["chat"], sample["debtor"]))),
+    ("get_debts_by_creditor_id", _fetchall(
+        "SELECT debt_id, debtor_id, creditor_id, amount_minor, currency, date FROM debts WHERE chat_id = ? and creditor_id = ?",
+        lambda sample: (sample["chat"], sample["creditor"]))),
+    ("get_debts_by_currency", _fetchall(
+        "SELECT debt_id, amount_minor FROM debts WHERE chat_id = ? and creditor_id = ? and debtor_id = ? and currency = ?",
+        lambda sample: (sample["chat"], sample["creditor"], sample["debtor"], "USD"))),
+    ("get_debts_page chat >", _page("chat", "after")),
+    ("get_debts_page chat <", _page("chat", "before")),
+    ("get_debts_page creditor >", _page("creditor", "after")),
+    ("get_debts_page debtor >", _page("debtor", "after")),
+    ("get_users_in_chat", _fetchall(
+        "SELECT user_id, username FROM users WHERE chat_id = ?",
+        lambda sample: (sample["chat"],))),
+    ("get_user_id_by_username", _fetchall(
+        "SELECT user_id FROM users WHERE username = ?",
+        lambda sample: (sample["username"],))),
+]
+
+
+def populate(connection, debts_count):
+    chats = max(debts_count // DEBTS_PER_CHAT, 1)
+    connection.executemany("INSERT INTO chats (chat_id) VALUES (?)", ((chat,) for chat in range(chats)))
+    connection.executemany(
+        "INSERT INTO users (user_id, chat_id, username, phone_number) VALUES (?, ?, ?, '')",
+        ((chat * USERS_PER_CHAT + user, chat, f"user{chat * USERS_PER_CHAT + user}")
+         for chat in range(chats) for user in range(USERS_PER_CHAT))
+    )
+
+    def debts():
+        for _ in range(debts_count):
+            chat = random.randrange(chats)
+            creditor, debtor = random.sample(range(USERS_PER_CHAT), 2)
+            yield (chat * USERS_PER_CHAT + creditor, chat * USERS_PER_CHAT + debtor, random.randint(1, 10000),
+                   random.choice(("USD", "EUR", "RUB")), "2024-01-01", chat)
+
+    # триггеры balances срабатывают и здесь, как при обычной записи
+    connection.executemany(
+        "INSERT INTO debts (creditor_id, debtor_id, amount_minor, currency, date, chat_id) VALUES (?, ?, ?, ?, ?, ?)",
+        debts()
+    )
+    connection.commit()
+    return chats
+
+
+def drop_indexes(connection):
+    for (name,) in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name IN ('debts', 'users') AND sql IS NOT NULL"
+    ).fetchall():
+        connection.execute(f"DROP INDEX {name}")
+    connection.commit()
+
+
+def time_queries(connection, chats, debts_count, repeat):
+    # -> {метод: среднее время запроса в микросекундах}
+    samples = []
+    for _ in range(repeat):
+        chat = random.randrange(chats)
+        users = random.sample(range(USERS_PER_CHAT), SPLIT_SIZE + 1)
+        creditor, *split = (chat * USERS_PER_CHAT + user for user in users)
+        samples.append({
+            "chat": chat, "creditor": creditor, "debtor": split[0], "split": split,
+            "username": f"user{chat * USERS_PER_CHAT}", "debt_id": random.randint(1, debts_count),
+        })
+
+    results = {}
+    for name, query in QUERIES:
+        start = time.perf_counter()
+        for sample in samples:
+            query(connection, sample)
+        results[name] = (time.perf_counter() - start) / repeat * 1e6
+    return results
+
+
+def bench(debts_count, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        Database(path).migrate()
+        connection = sqlite3.connect(path)
+        chats = populate(connection, debts_count)
+
+        steps = []
+        drop_indexes(connection)
+        for create in (None, _create_indexes, _create_chat_debts_index):
+            if create is not None:
+                create(connection.cursor())
+                connection.execute("ANALYZE")
+                connection.commit()
+            steps.append(time_queries(connection, chats, debts_count, repeat))
+        connection.close()
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="строк в debts")
+    parser.add_argument("--repeat", type=int, default=200, help="запросов на замер")
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f"{'debts':>9}  {'query':<26} {'no index, us':>13} {'migration 1, us':>16} {'all, us':>9} {'speedup':>8}")
+    for debts_count in args.sizes:
+        none, migration_1, everything = bench(debts_count, args.repeat)
+        for name, _ in QUERIES:
+            print(f"{debts_count:>9}  {name:<26} {none[name]:>13.1f} {migration_1[name]:>16.1f} {everything[name]:>9.1f} "
+                  f"{none[name] / everything[name]:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
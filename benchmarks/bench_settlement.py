@@ -0,0 +1,55 @@
+"""Время и число переводов settle_greedy и settle_exact в зависимости от размера группы.
+
+    python benchmarks/bench_settlement.py [--greedy-sizes 10 100 1000 10000 100000] [--exact-sizes 5 10 12 14 15]
+
+Балансы случайные, в минимальных единицах, с нулевой суммой - как после net_balances.
+Для каждого размера печатается среднее время и среднее число переводов; для сравнения
+с попарным взаиморасчетом - число пар n * (n - 1) / 2.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tech.settlement import net_balances, settle_exact, settle_greedy  # noqa: E402
+
+
+def random_balances(members):
+    # случайные траты внутри группы -> балансы, как их считает /settle
+    debts = []
+    for _ in range(members * 3):
+        debtor_id, creditor_id = random.sample(range(members), 2)
+        debts.append((debtor_id, creditor_id, random.randint(1, 100000)))
+    return net_balances(debts)
+
+
+def bench(settle, members, runs):
+    # -> (среднее время в миллисекундах, среднее число переводов)
+    groups = [random_balances(members) for _ in range(runs)]
+    transfers = 0
+    start = time.perf_counter()
+    for balances in groups:
+        transfers += len(settle(balances))
+    return (time.perf_counter() - start) / runs * 1000, transfers / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--greedy-sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--exact-sizes", type=int, nargs="+", default=[5, 10, 12, 14, 15])
+    parser.add_argument("--runs", type=int, default=5, help="групп на размер")
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f"{'mode':<6} {'members':>8} {'ms':>10} {'transfers':>10} {'pairs':>12}")
+    for mode, settle, sizes in (("greedy", settle_greedy, args.greedy_sizes), ("exact", settle_exact, args.exact_sizes)):
+        for members in sizes:
+            elapsed, transfers = bench(settle, members, args.runs)
+            print(f"{mode:<6} {members:>8} {elapsed:>10.2f} {transfers:>10.1f} {members * (members - 1) // 2:>12}")
+
+
+if __name__ == "__main__":
+    main()
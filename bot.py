@@ -1,14 +1,18 @@
+import asyncio
+import datetime
+import multiprocessing
 import os
 
+from aiohttp import web
 from aiogram import Bot, types
-from aiogram.contrib.fsm_storage.files import JSONStorage
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher import Dispatcher, FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils import executor, markdown as md
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
-from tech import Database, texts, get_exchange_rate, CURRENCY_EXCHANGE_OPTIONS
+from tech import ChatSerializationMiddleware, Database, Money, RatesPrefetcher, ReminderScheduler, SendScheduler, ShardRouter, SQLiteStorage, texts, sum_balances, settle, get_exchange_rates, set_rate_provider, set_rates_pool, FileRateProvider, CURRENCY_EXCHANGE_OPTIONS
 
 
 LANG_OPTIONS = {
@@ -17,14 +21,54 @@ LANG_OPTIONS = {
 }
 
 BOT_API_TOKEN = os.environ.get('BOT_API_TOKEN')
+# CSV/Parquet с историей курсов для работы без доступа к Yahoo
+RATES_FILE = os.environ.get('RATES_FILE')
+# адрес Bot API, например заглушки для локальной проверки; по умолчанию api.telegram.org
+TELEGRAM_API_SERVER = os.environ.get('TELEGRAM_API_SERVER')
+
+# если задан WEBHOOK_PATH, бот принимает обновления по вебхуку вместо long polling;
+# WEBHOOK_URL - внешний адрес, который регистрируется в Telegram при старте (без него
+# вебхук должен быть зарегистрирован заранее, например за балансировщиком)
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBAPP_HOST = os.environ.get('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.environ.get('WEBAPP_PORT', 8080))
+HEALTH_PATH = os.environ.get('HEALTH_PATH', '/health')
+# SHARDS > 1 в режиме вебхука: основной процесс только принимает обновления и раскладывает их
+# по SHARDS процессам по chat_id; шард i слушает 127.0.0.1:SHARD_BASE_PORT + i, у каждого
+# свой пул соединений с базой и свое хранилище FSM
+SHARDS = int(os.environ.get('SHARDS', 1))
+# без вебхука (long polling) SHARDS не действует и бот работает одним процессом
+SHARDED = bool(WEBHOOK_PATH) and SHARDS > 1
+SHARD_BASE_PORT = int(os.environ.get('SHARD_BASE_PORT', 8100))
+SHARD_PATH = '/update'
+# строк в одной странице /debts, /debts_to_me и /my_debts
+DEBTS_PAGE_SIZE = 20
+
+if TELEGRAM_API_SERVER:
+    bot = Bot(token=BOT_API_TOKEN, parse_mode="MarkdownV2", server=TelegramAPIServer.from_base(TELEGRAM_API_SERVER))
+else:
+    bot = Bot(token=BOT_API_TOKEN, parse_mode="MarkdownV2")
 
-bot = Bot(token=BOT_API_TOKEN, parse_mode="MarkdownV2")
-storage = JSONStorage('./storage.json')
+db = Database()
+# состояния FSM лежат в той же базе и пишутся построчно; пул открывается в db.start()
+storage = SQLiteStorage(db.pool)
 
 dp = Dispatcher(bot, storage=storage)
+# первым: обновления одного чата выполняются по очереди, разные чаты - параллельно
+chat_serializer = ChatSerializationMiddleware()
+dp.middleware.setup(chat_serializer)
 dp.middleware.setup(LoggingMiddleware())
 
-db = Database()
+if RATES_FILE:
+    set_rate_provider(FileRateProvider(RATES_FILE))
+# кэш курсов пишет в ту же базу через пул, не блокируя event loop
+set_rates_pool(db.pool)
+
+rates_prefetcher = RatesPrefetcher(db)
+# личные сообщения пользователям идут через очередь с учетом лимитов Telegram
+send_scheduler = SendScheduler(bot, shards=SHARDS if SHARDED else 1)
+reminder_scheduler = ReminderScheduler(db, send_scheduler)
 
 
 class ExpenseState(StatesGroup):
@@ -47,17 +91,17 @@ async def reset_state(message: types.Message, state: FSMContext) -> None:
 
 @dp.message_handler(commands=["start"], state="*")
 async def start_command(message: types.Message, state: FSMContext) -> None:
-    db.register_chat(message.chat.id)
+    await db.register_chat(message.chat.id)
 
-    lang = db.get_chat_lang(message.chat.id)
+    lang = await db.get_chat_lang(message.chat.id)
 
     await reset_state(message, state)
 
-    hello_phrase = texts.HELLO[lang] + message.from_user.first_name + "\\!"
+    hello_phrase = texts.HELLO.render(lang) + md.escape_md(message.from_user.first_name) + "\\!"
     await message.answer(
         md.text(
             hello_phrase,
-            md.escape_md(texts.START_TEXT[lang]),
+            texts.START_TEXT.render(lang),
             sep="\n"
         ),
         reply_markup=types.ReplyKeyboardRemove()
@@ -68,9 +112,9 @@ async def start_command(message: types.Message, state: FSMContext) -> None:
 @dp.message_handler(commands=["help"], state="*")
 async def help_command(message: types.Message, state: FSMContext) -> None:
     await reset_state(message, state)
-    lang = db.get_chat_lang(message.chat.id)
+    lang = await db.get_chat_lang(message.chat.id)
     await message.answer(
-        md.escape_md(texts.HELP_TEXT[lang]),
+        texts.HELP_TEXT.render(lang),
         reply_markup=types.ReplyKeyboardRemove()
     )
     await state.update_data(keyboard_deleted=False)
@@ -80,19 +124,19 @@ async def help_command(message: types.Message, state: FSMContext) -> None:
 async def register_command(message: types.Message, state: FSMContext) -> None:
     await reset_state(message, state)
 
-    lang = db.get_chat_lang(message.chat.id)
+    lang = await db.get_chat_lang(message.chat.id)
 
     args = message.get_args().split()
     if len(args) < 2:
         await state.update_data(keyboard_deleted=False)
-        await message.reply(md.escape_md(texts.REGISTER_TEXT_WRONG_FORMAT[lang]))
+        await message.reply(texts.REGISTER_TEXT_WRONG_FORMAT.render(lang))
         return
 
-    db.register_user(message, args[0], args[1])
+    await db.register_user(message, args[0], args[1])
 
     await message.reply(
         md.text(
-            md.escape_md(texts.REGISTER_TEXT[lang]),
+            texts.REGISTER_TEXT.render(lang),
             sep="\n"
         ),
         reply_markup=types.ReplyKeyboardRemove()
@@ -104,31 +148,41 @@ async def register_command(message: types.Message, state: FSMContext) -> None:
 @dp.message_handler(commands=["lang"], state="*")
 async def lang_command(message: types.Message, state: FSMContext) -> None:
     await reset_state(message, state)
-    lang = db.get_chat_lang(message.chat.id)
+    lang = await db.get_chat_lang(message.chat.id)
     markup = InlineKeyboardMarkup(row_width=2)
     for value, human_name in LANG_OPTIONS.items():
         lang_button = InlineKeyboardButton(human_name, callback_data=f'set_lang:{value}')
         markup.add(lang_button)
 
-    await message.reply(md.escape_md(texts.LANGUAGE_CHOOSE[lang]), reply_markup=markup)
+    await message.reply(texts.LANGUAGE_CHOOSE.render(lang), reply_markup=markup)
 
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith('set_lang:'))
 async def set_language(callback_query: types.CallbackQuery):
     lang = callback_query.data.split(':')[1]
 
-    db.update_chat_lang(callback_query.message.chat.id, lang)
-    lang = db.get_chat_lang(callback_query.message.chat.id)
+    await db.update_chat_lang(callback_query.message.chat.id, lang)
+
+    await callback_query.message.edit_text(texts.LANGUAGE_SET_TO.render(lang, LANG_OPTIONS[lang]))
+    await callback_query.answer(texts.LANGUAGE_UPDATED.render(lang))
+
 
-    await callback_query.message.edit_text(md.escape_md(texts.LANGUAGE_SET_TO[lang].format(LANG_OPTIONS[lang])))
-    await callback_query.answer(md.escape_md(texts.LANGUAGE_UPDATED[lang]))
+def _delivery_failed(future):
+    return not future.cancelled() and future.exception() is not None
+
+
+def report_to_chat(message, text):
+    # ответ в чат после фоновой доставки: идет через SendScheduler, а не напрямую
+    report = send_scheduler.enqueue(message.chat.id, text, reply_to_message_id=message.message_id,
+                                    allow_sending_without_reply=True)
+    report.add_done_callback(_delivery_failed)
 
 
 @dp.message_handler(commands=["ping"], state="*")
 async def ping_command(message: types.Message, state: FSMContext) -> None:
     await reset_state(message, state)
 
-    lang = db.get_chat_lang(message.chat.id)
+    lang = await db.get_chat_lang(message.chat.id)
 
     username = None
     if message.entities:
@@ -140,51 +194,131 @@ async def ping_command(message: types.Message, state: FSMContext) -> None:
                 break
 
     if username:
-        user_id = db.get_user_id_by_username(username)
+        user_id = await db.get_user_id_by_username(username)
 
         if user_id:
             try:
-                debts = db.get_debts_for_pair(message.chat.id, message.from_user.id, user_id)
+                debts = await db.get_debts_for_pair(message.chat.id, message.from_user.id, user_id)
 
                 if len(debts) == 0:
-                    text = md.escape_md(texts.PING_NO_DEBT[lang].format(message.from_user.full_name))
+                    text = texts.PING_NO_DEBT.render(lang, message.from_user.full_name)
                 else:
-                    text = md.escape_md(texts.PING_START[lang].format(message.from_user.full_name))
+                    text = texts.PING_START.render(lang, message.from_user.full_name)
 
                 for debt in debts:
-                    text += md.escape_md(f"{debt[3]} {debt[4]}\n")
-
-                await bot.send_message(user_id, text)
-                await message.reply(md.escape_md(texts.SUCCESSFULL_MESSAGE[lang]))
+                    text += md.escape_md(f"{Money(debt[3], debt[4])}\n")
+
+                # не ждем доставки: пауза по RetryAfter не должна держать очередь обновлений чата
+                delivery = send_scheduler.enqueue(user_id, text)
+                delivery.add_done_callback(
+                    lambda f: _delivery_failed(f) and report_to_chat(message, texts.CANNOT_SEND_MESSAGE.render(lang, username))
+                )
+                await message.reply(texts.MESSAGE_QUEUED.render(lang))
             except Exception:
-                await message.reply(md.escape_md(texts.CANNOT_SEND_MESSAGE[lang].format(username)))
+                await message.reply(texts.CANNOT_SEND_MESSAGE.render(lang, username))
         else:
-            await message.reply(md.escape_md(texts.USER_NOT_FOUND[lang]))
+            await message.reply(texts.USER_NOT_FOUND.render(lang))
     else:
-        await message.reply(md.escape_md(texts.PING_WRONG_FORMAT[lang]))
+        await message.reply(texts.PING_WRONG_FORMAT.render(lang))
+
+    await state.update_data(keyboard_deleted=False)
+
 
+@dp.message_handler(commands=["ping_all"], state="*")
+async def ping_all_command(message: types.Message, state: FSMContext) -> None:
+    await reset_state(message, state)
+    lang = await db.get_chat_lang(message.chat.id)
+
+    debts = await db.get_debts_by_creditor_id(message.chat.id, message.from_user.id)
+    if not debts:
+        await message.reply(texts.NOBODY_OWES.render(lang))
+        return
+
+    # одно сообщение каждому должнику со всеми его долгами вызывающему
+    texts_by_debtor = {}
+    for debt in debts:
+        if debt[1] not in texts_by_debtor:
+            texts_by_debtor[debt[1]] = texts.PING_START.render(lang, message.from_user.full_name)
+        texts_by_debtor[debt[1]] += md.escape_md(f"{Money(debt[3], debt[4])}\n")
+
+    usernames = await db.get_usernames(message.chat.id, list(texts_by_debtor))
+
+    def report(deliveries):
+        if deliveries.cancelled():
+            return
+        failed = [debtor_id for debtor_id, result in zip(texts_by_debtor, deliveries.result()) if isinstance(result, BaseException)]
+        if failed:
+            # один отчет на всех недоступных должников, через ту же очередь с лимитами
+            report_to_chat(message, texts.PING_ALL_SENT.render(
+                lang, len(texts_by_debtor) - len(failed), len(texts_by_debtor),
+                ', '.join(f"@{usernames.get(debtor_id)}" for debtor_id in failed)
+            ))
+
+    # доставки не ждем, пока держим очередь чата: отчет о недоставленных придет отдельно
+    deliveries = asyncio.gather(
+        *(send_scheduler.enqueue(debtor_id, text) for debtor_id, text in texts_by_debtor.items()),
+        return_exceptions=True
+    )
+    deliveries.add_done_callback(report)
+    await message.reply(texts.PING_ALL_QUEUED.render(lang, len(texts_by_debtor)))
     await state.update_data(keyboard_deleted=False)
 
 
+@dp.message_handler(commands=["remind"], state="*")
+async def remind_command(message: types.Message, state: FSMContext) -> None:
+    await reset_state(message, state)
+    lang = await db.get_chat_lang(message.chat.id)
+
+    args = message.get_args().split()
+    if not args:
+        interval = await db.get_reminder_interval(message.chat.id)
+        if interval is None:
+            await message.reply(texts.REMIND_NOT_SET.render(lang))
+        else:
+            await message.reply(texts.REMIND_SET.render(lang, interval // (24 * 60 * 60)))
+        return
+
+    if args[0] == "off":
+        await db.delete_reminder(message.chat.id)
+        await message.reply(texts.REMIND_OFF.render(lang))
+        return
+
+    if not args[0].isdigit() or int(args[0]) < 1:
+        await message.reply(texts.REMIND_WRONG_FORMAT.render(lang))
+        return
+
+    days = int(args[0])
+    await db.set_reminder(message.chat.id, days * 24 * 60 * 60)
+    reminder_scheduler.notify()
+    await message.reply(texts.REMIND_SET.render(lang, days))
+
+
 @dp.message_handler(commands=["expense"], state="*")
 async def expense_command(message: types.Message, state: FSMContext) -> None:
     await reset_state(message, state)
-    lang = db.get_chat_lang(message.chat.id)
+    lang = await db.get_chat_lang(message.chat.id)
 
     args = message.get_args().split(maxsplit=2)
     if len(args) < 3:
-        await message.reply(md.escape_md(texts.EXPENSE_WRONG_FORMAT[lang]))
+        await message.reply(texts.EXPENSE_WRONG_FORMAT.render(lang))
         return
 
     amount, currency, description = args
 
     if currency not in CURRENCY_EXCHANGE_OPTIONS:
-        await message.reply(md.escape_md(texts.WRONG_CURRENCY[lang].format(', '.join(CURRENCY_EXCHANGE_OPTIONS))))
+        await message.reply(texts.WRONG_CURRENCY.render(lang, ', '.join(CURRENCY_EXCHANGE_OPTIONS)))
         return
 
-    await state.update_data(amount=float(amount), lang=lang, currency=currency, description=description, chat_id=message.chat.id, selected_users=[])
+    try:
+        amount = Money.parse(amount, currency)
+    except ValueError:
+        await message.reply(texts.EXPENSE_WRONG_FORMAT.render(lang))
+        return
+
+    # в состоянии храним целые минимальные единицы - они без потерь переживают сериализацию в JSON
+    await state.update_data(amount=amount.minor, lang=lang, currency=currency, description=description, chat_id=message.chat.id, selected_users=[])
 
-    users = db.get_users_in_chat(message.chat.id)
+    users = await db.get_users_in_chat(message.chat.id)
     keyboard = InlineKeyboardMarkup(row_width=2)
     for user in users:
         button = InlineKeyboardButton(user[1], callback_data=f"user_{user[0]}")
@@ -194,7 +328,7 @@ async def expense_command(message: types.Message, state: FSMContext) -> None:
     keyboard.add(equal_button)
 
     await ExpenseState.choosing_users.set()
-    await message.reply(md.escape_md(texts.CHOOSE_USERS_FOR_SPLIT[lang]), reply_markup=keyboard)
+    await message.reply(texts.CHOOSE_USERS_FOR_SPLIT.render(lang), reply_markup=keyboard)
 
 
 @dp.callback_query_handler(lambda c: c.data.startswith("user_"), state=ExpenseState.choosing_users)
@@ -205,7 +339,7 @@ async def add_user_to_list(callback_query: types.CallbackQuery, state: FSMContex
 
     lang = data.get("lang", "ru")
 
-    users = db.get_users_in_chat(data['chat_id'])
+    users = await db.get_users_in_chat(data['chat_id'])
     keyboard = InlineKeyboardMarkup(row_width=2)
 
     if user_id not in selected_users:
@@ -236,101 +370,148 @@ async def process_equal_division(callback_query: types.CallbackQuery, state: FSM
     lang = data.get("lang", "ru")
 
     if not users:
-        await callback_query.message.reply(md.escape_md(texts.PLEASE_CHOOSE_USERS[lang]))
+        await callback_query.message.reply(texts.PLEASE_CHOOSE_USERS.render(lang))
         return
 
-    amount_per_user = data['amount'] / len(users)
-    for user_id in users:
-        await db.update_or_add_debt(
-            creditor_id=callback_query.from_user.id, debtor_id=user_id, amount=amount_per_user,
+    # остаток от деления в копейках достается первым участникам, сумма долей равна трате
+    shares = Money(data['amount'], data['currency']).split(len(users))
+    try:
+        await db.apply_expense_split(
+            creditor_id=callback_query.from_user.id, shares=dict(zip(users, shares)),
             currency=data['currency'], description=data['description'], chat_id=data['chat_id']
         )
+    except ValueError:
+        # у пары уже есть долг в другой валюте, а курса нет: трата не записана, ввод начинается заново
+        await callback_query.message.reply(texts.CURRENCY_CONVERTION_ERROR.render(lang))
+        await state.finish()
+        return
 
-    await callback_query.message.reply(md.escape_md(texts.DEBTS_UPDATED[lang]))
+    await callback_query.message.reply(texts.DEBTS_UPDATED.render(lang))
     await state.finish()
 
 
-@dp.message_handler(commands=["debts"], state="*")
-async def debts_command(message: types.Message, state: FSMContext):
-    await reset_state(message, state)
-    lang = db.get_chat_lang(message.chat.id)
+async def save_debts_query(state, chat_id, debts_filter, **params):
+    # в состоянии храним не сами долги, а как их перечитать: фильтр и версию журнала чата на момент показа
+    version = await db.get_ledger_version(chat_id)
+    await state.update_data(debts_query={'chat_id': chat_id, 'filter': debts_filter, 'version': version, **params})
 
-    debts = db.get_debts_from_chat(message.chat.id)
-    # (debt_id, debtor_id, creditor_id, amount, currency) с сортированными ID
 
+async def load_debts(debts_query):
+    # -> (debts, changed): актуальные долги по описанию из save_debts_query и признак того,
+    # что они менялись после показа пользователю
+    chat_id, debts_filter = debts_query['chat_id'], debts_query['filter']
+    if debts_filter == 'chat':
+        debts = await db.get_debts_from_chat(chat_id)
+    elif debts_filter == 'creditor':
+        debts = await db.get_debts_by_creditor_id(chat_id, debts_query['user_id'])
+    elif debts_filter == 'debtor':
+        debts = await db.get_debts_by_debtor_id(chat_id, debts_query['user_id'])
+    else:
+        debts = await db.get_debts_for_pair(chat_id, debts_query['creditor_id'], debts_query['debtor_id'])
+    changed = await db.get_ledger_version(chat_id) != debts_query['version']
+    return debts, changed
+
+
+async def render_debts_page(chat_id, lang, debts_filter, user_id, direction=None, cursor=None):
+    # -> (текст, клавиатура) или None, если долгов нет. Страница выбирается по ключу debt_id
+    # (keyset), а не по смещению: запрос читает только строки страницы и одну лишнюю,
+    # по которой видно, есть ли что-то дальше
+    if direction == 'p':
+        debts = await db.get_debts_page(chat_id, debts_filter, user_id, before=cursor, limit=DEBTS_PAGE_SIZE + 1)
+        has_prev, has_next = len(debts) > DEBTS_PAGE_SIZE, True
+        debts = debts[-DEBTS_PAGE_SIZE:]
+    else:
+        debts = await db.get_debts_page(chat_id, debts_filter, user_id, after=cursor, limit=DEBTS_PAGE_SIZE + 1)
+        has_prev, has_next = cursor is not None, len(debts) > DEBTS_PAGE_SIZE
+        debts = debts[:DEBTS_PAGE_SIZE]
+    # (debt_id, debtor_id, creditor_id, amount, currency, date) по возрастанию debt_id
     if not debts:
-        await message.reply(md.escape_md(texts.NO_ACTIVE_DEBTS[lang]))
-        return
-    
-    await state.update_data(debts_to_convert=debts)
-
-    response = md.escape_md(texts.DEBTS_IN_CHAT[lang])
-    for debt in debts:
-        username_1, username_2 = db.get_username_by_user_id(debt[1]), db.get_username_by_user_id(debt[2]), 
-        response += md.escape_md(texts.USER_OWES_USER[lang].format(username_1, username_2) + f" {debt[3]} {debt[4]}\n")
+        return None
+
+    usernames = await db.get_usernames(chat_id, [user_id] + [user for debt in debts for user in debt[1:3]])
+    if debts_filter == 'chat':
+        response = texts.DEBTS_IN_CHAT.render(lang)
+        for debt in debts:
+            username_1, username_2 = usernames.get(debt[1]), usernames.get(debt[2])
+            response += texts.USER_OWES_USER.render(lang, username_1, username_2) + md.escape_md(f" {Money(debt[3], debt[4])}\n")
+    elif debts_filter == 'creditor':
+        response = texts.WHO_OWES.render(lang, usernames.get(user_id))
+        for debt in debts:
+            response += texts.USER_OWES_YOU.render(lang, usernames.get(debt[1])) + md.escape_md(f" {Money(debt[3], debt[4])}\n")
+    else:
+        response = texts.YOU_OWE.render(lang, usernames.get(user_id))
+        for debt in debts:
+            response += texts.YOU_OWE_USER.render(lang, usernames.get(debt[2])) + md.escape_md(f" {Money(debt[3], debt[4])}\n")
 
-    keyboard = InlineKeyboardMarkup()
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    # callback_data: debts_page:фильтр:пользователь:направление:debt_id (до 64 байт)
+    page_buttons = []
+    if has_prev:
+        page_buttons.append(InlineKeyboardButton(texts.PREV_PAGE[lang], callback_data=f"debts_page:{debts_filter}:{user_id}:p:{debts[0][0]}"))
+    if has_next:
+        page_buttons.append(InlineKeyboardButton(texts.NEXT_PAGE[lang], callback_data=f"debts_page:{debts_filter}:{user_id}:n:{debts[-1][0]}"))
+    if page_buttons:
+        keyboard.row(*page_buttons)
 
     convert_button = InlineKeyboardButton(texts.CONVERT_TO_CURRENCY[lang], callback_data="choose_currency")
     keyboard.add(convert_button)
+    return response, keyboard
 
-    await message.reply(response, reply_markup=keyboard)
 
-
-@dp.message_handler(commands=["debts_to_me"], state="*")
-async def debts_to_me_command(message: types.Message, state: FSMContext) -> None:
+@dp.message_handler(commands=["debts"], state="*")
+async def debts_command(message: types.Message, state: FSMContext):
     await reset_state(message, state)
-    lang = db.get_chat_lang(message.chat.id)
-
-    debts = db.get_debts_by_creditor_id(message.chat.id, message.from_user.id)
-    # (debt_id, debtor_id, creditor_id, amount, currency) с сортированными ID
+    lang = await db.get_chat_lang(message.chat.id)
 
-    if not debts:
-        await message.reply(md.escape_md(texts.NOBODY_OWES[lang]))
+    page = await render_debts_page(message.chat.id, lang, 'chat', message.from_user.id)
+    if page is None:
+        await message.reply(texts.NO_ACTIVE_DEBTS.render(lang))
         return
-    
-    await state.update_data(debts_to_convert=debts)
 
-    creditor_name = db.get_username_by_user_id(message.from_user.id)
+    await save_debts_query(state, message.chat.id, 'chat')
+    await message.reply(page[0], reply_markup=page[1])
 
-    response =  md.escape_md(texts.WHO_OWES[lang].format(creditor_name))
-    for debt in debts:
-        debtor = db.get_username_by_user_id(debt[1])
-        response += md.escape_md(texts.USER_OWES_YOU[lang].format(debtor) + f" {debt[3]} {debt[4]}\n")
 
-    keyboard = InlineKeyboardMarkup()
-    convert_button = InlineKeyboardButton(texts.CONVERT_TO_CURRENCY[lang], callback_data="choose_currency")
-    keyboard.add(convert_button)
+@dp.message_handler(commands=["debts_to_me"], state="*")
+async def debts_to_me_command(message: types.Message, state: FSMContext) -> None:
+    await reset_state(message, state)
+    lang = await db.get_chat_lang(message.chat.id)
 
-    await message.reply(response, reply_markup=keyboard)
+    page = await render_debts_page(message.chat.id, lang, 'creditor', message.from_user.id)
+    if page is None:
+        await message.reply(texts.NOBODY_OWES.render(lang))
+        return
+
+    await save_debts_query(state, message.chat.id, 'creditor', user_id=message.from_user.id)
+    await message.reply(page[0], reply_markup=page[1])
 
 
 @dp.message_handler(commands=["my_debts"], state="*")
 async def my_debts_command(message: types.Message, state: FSMContext) -> None:
     await reset_state(message, state)
-    lang = db.get_chat_lang(message.chat.id)
+    lang = await db.get_chat_lang(message.chat.id)
 
-    debts = db.get_debts_by_debtor_id(message.chat.id, message.from_user.id)
-    # (debt_id, debtor_id, creditor_id, amount, currency, date) с сортированными ID
-    if not debts:
-        await message.reply(md.escape_md(texts.YOU_OWE_NOONE[lang]))
+    page = await render_debts_page(message.chat.id, lang, 'debtor', message.from_user.id)
+    if page is None:
+        await message.reply(texts.YOU_OWE_NOONE.render(lang))
         return
 
-    await state.update_data(debts_to_convert=debts)
-
-    debtor_name = db.get_username_by_user_id(message.from_user.id)
-
-    response = md.escape_md(texts.YOU_OWE[lang].format(debtor_name))
-    for debt in debts:
-        creditor = db.get_username_by_user_id(debt[2])
-        response += md.escape_md(texts.YOU_OWE_USER[lang].format(creditor) + f" {debt[3]} {debt[4]}\n")
+    await save_debts_query(state, message.chat.id, 'debtor', user_id=message.from_user.id)
+    await message.reply(page[0], reply_markup=page[1])
 
-    keyboard = InlineKeyboardMarkup()
 
-    convert_button = InlineKeyboardButton(texts.CONVERT_TO_CURRENCY[lang], callback_data="choose_currency")
-    keyboard.add(convert_button)
+@dp.callback_query_handler(lambda c: c.data.startswith("debts_page:"), state="*")
+async def debts_page(callback_query: types.CallbackQuery, state: FSMContext):
+    await callback_query.answer()
+    _, debts_filter, user_id, direction, cursor = callback_query.data.split(":")
+    chat_id = callback_query.message.chat.id
+    lang = await db.get_chat_lang(chat_id)
 
-    await message.reply(response, reply_markup=keyboard)
+    page = await render_debts_page(chat_id, lang, debts_filter, int(user_id), direction, int(cursor))
+    if page is None:
+        await callback_query.message.edit_text(texts.NO_ACTIVE_DEBTS.render(lang))
+        return
+    await callback_query.message.edit_text(page[0], reply_markup=page[1])
 
 
 @dp.callback_query_handler(lambda c: c.data == "choose_currency", state="*")
@@ -343,7 +524,7 @@ async def choose_currency(callback_query: types.CallbackQuery, state: FSMContext
         currency_button = InlineKeyboardButton(currency, callback_data=f"convert_to_{currency}")
         keyboard.add(currency_button)
 
-    await callback_query.message.reply(md.escape_md(texts.CURRENCY_TO_CAST[lang]), reply_markup=keyboard)
+    await callback_query.message.reply(texts.CURRENCY_TO_CAST.render(lang), reply_markup=keyboard)
 
 
 @dp.callback_query_handler(text_contains="convert_to_", state="*")
@@ -352,54 +533,124 @@ async def convert_currency(callback_query: types.CallbackQuery, state: FSMContex
     selected_currency = callback_query.data.split("_")[2]
 
     data = await state.get_data()
-    debts_to_convert = data.get("debts_to_convert", [])
+    debts_query = data.get("debts_query")
     lang = data.get("lang", "ru")
 
+    debts_to_convert, changed = await load_debts(debts_query) if debts_query else ([], False)
     if not debts_to_convert:
-        await callback_query.message.reply(md.escape_md(texts.NO_DEBTS_SELECTED[lang]))
+        await callback_query.message.reply(texts.NO_DEBTS_SELECTED.render(lang))
         return
+    if changed:
+        await callback_query.message.reply(texts.DEBTS_CHANGED.render(lang))
 
     consolidated_debts = {}
 
-    for debt in debts_to_convert:
+    rates = await get_exchange_rates((debt[4], selected_currency, debt[5]) for debt in debts_to_convert)
+    if any(rate is None for rate in rates):
+        await callback_query.message.reply(texts.CURRENCY_CONVERTION_ERROR.render(lang))
+
+    for debt, rate in zip(debts_to_convert, rates):
         debtor_id, creditor_id = debt[1], debt[2]
         amount, currency, date = debt[3], debt[4], debt[5]
 
         key = tuple(sorted([debtor_id, creditor_id]))
 
-        if currency in CURRENCY_EXCHANGE_OPTIONS and currency != selected_currency:
-            try:
-                amount = await get_exchange_rate(currency, selected_currency, amount, date)
-                currency = selected_currency
-            except Exception as e:
-                await callback_query.message.reply(md.escape_md(texts.CURRENCY_CONVERTION_ERROR[lang]))
-                continue
+        if rate is None:
+            continue
+        amount = Money(amount, currency).convert(rate, selected_currency)
 
         if key not in consolidated_debts:
-            consolidated_debts[key] = [0, selected_currency]
+            consolidated_debts[key] = Money.zero(selected_currency)
 
         if debtor_id < creditor_id:
-            consolidated_debts[key][0] += amount
+            consolidated_debts[key] += amount
         else:
-            consolidated_debts[key][0] -= amount
-
-    response = md.escape_md(texts.DEBTS_CONVERTED_TO[lang].format(selected_currency))
-    for (debtor_id, creditor_id), (amount, currency) in consolidated_debts.items():
-        username1 = db.get_username_by_user_id(debtor_id)
-        username2 = db.get_username_by_user_id(creditor_id)
-        if amount >= 0:
-            response += md.escape_md(texts.USER_OWES_USER[lang].format(username1, username2) + f" {abs(amount)} {currency}\n")
+            consolidated_debts[key] -= amount
+
+    usernames = await db.get_usernames(callback_query.message.chat.id, [user_id for key in consolidated_debts for user_id in key])
+
+    response = texts.DEBTS_CONVERTED_TO.render(lang, selected_currency)
+    for (debtor_id, creditor_id), amount in consolidated_debts.items():
+        username1 = usernames.get(debtor_id)
+        username2 = usernames.get(creditor_id)
+        if amount.minor >= 0:
+            response += texts.USER_OWES_USER.render(lang, username1, username2) + md.escape_md(f" {abs(amount)}\n")
         else:
-            response += md.escape_md(texts.USER_OWES_USER[lang].format(username2, username1) + f" {abs(amount)} {currency}\n")
+            response += texts.USER_OWES_USER.render(lang, username2, username1) + md.escape_md(f" {abs(amount)}\n")
 
     await callback_query.message.reply(response)
     await state.finish()
 
 
+@dp.message_handler(commands=["settle"], state="*")
+async def settle_command(message: types.Message, state: FSMContext) -> None:
+    await reset_state(message, state)
+    lang = await db.get_chat_lang(message.chat.id)
+
+    args = message.get_args().split()
+    if len(args) < 1 or args[0] not in CURRENCY_EXCHANGE_OPTIONS:
+        await message.reply(texts.SETTLE_WRONG_FORMAT.render(lang, ', '.join(CURRENCY_EXCHANGE_OPTIONS)))
+        return
+    target_currency = args[0]
+
+    chat_balances = await db.get_balances(message.chat.id)
+    # (user_id, currency, balance в минимальных единицах)
+    if not chat_balances:
+        await message.reply(texts.NO_ACTIVE_DEBTS.render(lang))
+        return
+
+    # закрываем долги сейчас, поэтому все суммы приводим по сегодняшнему курсу
+    today = str(datetime.datetime.now(tz=datetime.timezone.utc))
+    rates = await get_exchange_rates((row[1], target_currency, today) for row in chat_balances)
+    if any(rate is None for rate in rates):
+        await message.reply(texts.CURRENCY_CONVERTION_ERROR.render(lang))
+        return
+
+    balances = sum_balances(
+        (row[0], Money(row[2], row[1]).convert(rate, target_currency).minor) for row, rate in zip(chat_balances, rates)
+    )
+    transfers = settle(balances)
+    if not transfers:
+        await message.reply(texts.NO_ACTIVE_DEBTS.render(lang))
+        return
+
+    usernames = await db.get_usernames(message.chat.id, list(balances))
+
+    response = texts.SETTLE_PLAN.render(lang, target_currency)
+    for debtor_id, creditor_id, amount in transfers:
+        response += texts.USER_OWES_USER.render(lang, usernames.get(debtor_id), usernames.get(creditor_id)) + md.escape_md(f" {Money(amount, target_currency)}\n")
+
+    await message.reply(response)
+    await state.update_data(keyboard_deleted=False)
+
+
+@dp.message_handler(commands=["ledger"], state="*")
+async def ledger_command(message: types.Message, state: FSMContext) -> None:
+    await reset_state(message, state)
+    lang = await db.get_chat_lang(message.chat.id)
+
+    # долги пересчитываются из журнала: последний снимок плюс хвост событий после него
+    ledger_state, _ = await db.replay_ledger(message.chat.id)
+    pairs = sorted((key, amount) for key, amount in ledger_state.items() if amount != 0)
+    if not pairs:
+        await message.reply(texts.NO_ACTIVE_DEBTS.render(lang))
+        return
+
+    usernames = await db.get_usernames(message.chat.id, list({user_id for (user_a, user_b, _), _ in pairs for user_id in (user_a, user_b)}))
+
+    response = texts.LEDGER_BALANCES.render(lang)
+    for (user_a, user_b, currency), amount in pairs:
+        debtor_id, creditor_id = (user_a, user_b) if amount > 0 else (user_b, user_a)
+        response += texts.USER_OWES_USER.render(lang, usernames.get(debtor_id), usernames.get(creditor_id)) + md.escape_md(f" {Money(abs(amount), currency)}\n")
+
+    await message.reply(response)
+    await state.update_data(keyboard_deleted=False)
+
+
 @dp.message_handler(commands=["pay_debt"], state="*")
 async def pay_debt_command(message: types.Message, state: FSMContext) -> None:
     await reset_state(message, state)
-    lang = db.get_chat_lang(message.chat.id)
+    lang = await db.get_chat_lang(message.chat.id)
 
     username = None
     if message.entities:
@@ -411,35 +662,35 @@ async def pay_debt_command(message: types.Message, state: FSMContext) -> None:
                 break
 
     if not username:
-        await message.reply(md.escape_md(texts.PAY_DEBT_WRONG_FORMAT[lang]))
+        await message.reply(texts.PAY_DEBT_WRONG_FORMAT.render(lang))
         await state.update_data(keyboard_deleted=False)
         return
     
-    creditor_id = db.get_user_id_by_username(username)
+    creditor_id = await db.get_user_id_by_username(username)
     if not creditor_id:
-        await message.reply(md.escape_md(texts.USER_NOT_FOUND[lang]))
+        await message.reply(texts.USER_NOT_FOUND.render(lang))
         return
     
     debtor_id = message.from_user.id
-    debts = db.get_debts_for_pair(message.chat.id, creditor_id, debtor_id)
+    debts = await db.get_debts_for_pair(message.chat.id, creditor_id, debtor_id)
     if not debts:
-        await message.reply(md.escape_md(texts.NO_DEBTS_TO_USER[lang]))
+        await message.reply(texts.NO_DEBTS_TO_USER.render(lang))
         return
     
-    phone_number, preferred_bank = db.get_user_contact_info(message.chat.id, creditor_id)
+    phone_number, preferred_bank = await db.get_user_contact_info(message.chat.id, creditor_id)
 
-    response = md.escape_md(texts.ALL_DEBTS_TO_USER[lang].format(username))
+    response = texts.ALL_DEBTS_TO_USER.render(lang, username)
     for debt in debts:
-        response +=  md.escape_md(f"{debt[3]} {debt[4]}\n") # amount and currency
+        response +=  md.escape_md(f"{Money(debt[3], debt[4])}\n") # amount and currency
 
-    response += md.escape_md(texts.PHONE_BANK[lang].format(phone_number, preferred_bank))
+    response += texts.PHONE_BANK.render(lang, phone_number, preferred_bank)
 
     await state.set_data({
-        'debts': debts,
         'creditor_id': creditor_id,
         'debtor_id': debtor_id,
         'lang': lang
     })
+    await save_debts_query(state, message.chat.id, 'pair', creditor_id=creditor_id, debtor_id=debtor_id)
 
     keyboard = InlineKeyboardMarkup(row_width=2)
     convert_button = InlineKeyboardButton(texts.CONVERT_TO_CURRENCY[lang], callback_data="convert_for_payment")
@@ -451,21 +702,21 @@ async def pay_debt_command(message: types.Message, state: FSMContext) -> None:
 
 async def consolidate_and_convert_debts(debts, target_currency):
     converted_debts = {}
-    for debt in debts:
+    rates = await get_exchange_rates((debt[4], target_currency, debt[5]) for debt in debts)
+    for debt, rate in zip(debts, rates):
         debtor_id, creditor_id, amount, currency, date = debt[1], debt[2], debt[3], debt[4], debt[5]
-        if currency == target_currency:
-            converted_amount = amount
-        else:
-            converted_amount = await get_exchange_rate(currency, target_currency, amount, date)
+        if rate is None:
+            raise ValueError(f"No exchange rate for {currency} -> {target_currency} on {date}")
+        converted_amount = Money(amount, currency).convert(rate, target_currency)
 
         # Создаем ключ из ID дебитора и кредитора для агрегации
         key = (debtor_id, creditor_id)
         if key in converted_debts:
             # Суммируем суммы, если ключ уже есть
-            converted_debts[key] = (converted_debts[key][0] + converted_amount, target_currency)
+            converted_debts[key] += converted_amount
         else:
-            # Добавляем новый ключ с суммой и валютой
-            converted_debts[key] = (converted_amount, target_currency)
+            # Добавляем новый ключ с суммой
+            converted_debts[key] = converted_amount
     return converted_debts
 
 
@@ -479,7 +730,7 @@ async def convert_for_payment(callback_query: types.CallbackQuery, state: FSMCon
         currency_button = InlineKeyboardButton(currency, callback_data=f"currency_for_payment_{currency}")
         keyboard.add(currency_button)
 
-    await callback_query.message.reply(md.escape_md(texts.CURRENCY_TO_CAST[lang]), reply_markup=keyboard)
+    await callback_query.message.reply(texts.CURRENCY_TO_CAST.render(lang), reply_markup=keyboard)
 
 
 @dp.callback_query_handler(text_contains="currency_for_payment_", state="*")
@@ -488,19 +739,25 @@ async def convert_debts_for_payment(callback_query: types.CallbackQuery, state:
     selected_currency = callback_query.data.split("_")[3]
 
     data = await state.get_data()
-    debts = data.get('debts')
+    debts_query = data.get("debts_query")
     lang = data.get("lang", "ru")
 
+    debts, changed = await load_debts(debts_query) if debts_query else ([], False)
+    if not debts:
+        await callback_query.message.reply(texts.NO_DEBTS_TO_USER.render(lang))
+        return
+    if changed:
+        await callback_query.message.reply(texts.DEBTS_CHANGED.render(lang))
+
     converted_values = await consolidate_and_convert_debts(debts, selected_currency)
-    await state.update_data({'debts': converted_values})
 
     keyboard = InlineKeyboardMarkup()
     pay_button = InlineKeyboardButton(texts.PAY[lang], callback_data="initiate_payment")
     keyboard.add(pay_button)
 
-    response = md.escape_md(texts.DEBTS_CONVERTED_TO[lang].format(selected_currency))
-    for (amount, currency) in converted_values.values():
-        response += md.escape_md(f"{amount} {currency}\n")
+    response = texts.DEBTS_CONVERTED_TO.render(lang, selected_currency)
+    for amount in converted_values.values():
+        response += md.escape_md(f"{amount}\n")
 
     await callback_query.message.reply(response, reply_markup=keyboard)
     await callback_query.answer()
@@ -514,76 +771,203 @@ async def initiate_payment_process(callback_query: types.CallbackQuery, state: F
     lang = data.get("lang", "ru")
 
     await state.set_state(DebtPaymentStates.awaiting_payment)
-    await callback_query.message.reply(texts.PAYMENT_FORMAT[lang])
+    await callback_query.message.reply(texts.PAYMENT_FORMAT.render(lang))
 
 
-async def process_payment_logic(message, amount_paid, currency_paid, state):
+async def process_payment_logic(message, amount_paid, state):
     data = await state.get_data()
     debtor_id = data['debtor_id']
     creditor_id = data['creditor_id']
     lang = data.get("lang", "ru")
+    currency_paid = amount_paid.currency
 
     # Реализация функции ищет все долги в валюте платежа
-    specific_debts = db.get_debts_by_currency(message.chat.id, debtor_id, creditor_id, currency_paid)
-    # debt_id, amount
+    specific_debts = await db.get_debts_by_currency(message.chat.id, debtor_id, creditor_id, currency_paid)
+    # debt_id, amount_minor
     
     remaining_amount = amount_paid
+    # сначала считаем, какие долги гасятся, а пишем все одной транзакцией
+    paid_debts, updated_debts = [], []
+    conversion_failed = False
 
     for debt in specific_debts:
-        if remaining_amount <= db.epsilon:
+        if remaining_amount.minor <= 0:
             break
-        if remaining_amount >= debt[1]:
-            remaining_amount -= debt[1]
-            db.delete_debt(debt[0])
+        debt_amount = Money(debt[1], currency_paid)
+        if remaining_amount >= debt_amount:
+            remaining_amount -= debt_amount
+            paid_debts.append(debt[0])
         else:
-            db.update_debt(debt[0], debt[1] - remaining_amount)
-            remaining_amount = 0
+            updated_debts.append((debt[0], debt_amount - remaining_amount))
+            remaining_amount = Money.zero(currency_paid)
 
-    if remaining_amount > 0:
-        other_debts = db.get_other_currency_debts(message.chat.id, debtor_id, creditor_id, currency_paid)
-        # debt_id, amount, currency, date
+    if remaining_amount.minor > 0:
+        other_debts = await db.get_other_currency_debts(message.chat.id, debtor_id, creditor_id, currency_paid)
+        # debt_id, amount_minor, currency, date
+        rates = await get_exchange_rates((debt[2], currency_paid, debt[3]) for debt in other_debts)
 
-        for debt in other_debts:
-            if remaining_amount <= db.epsilon:
+        for debt, rate in zip(other_debts, rates):
+            if remaining_amount.minor <= 0:
                 break
-            try:
-                converted_amount = await get_exchange_rate(debt[2], currency_paid, debt[1], debt[3])
-            except Exception:
-                await message.reply(md.escape_md(texts.CONVERSION_ERROR[lang]))
+            if rate is None:
+                conversion_failed = True
                 continue
+            debt_amount = Money(debt[1], debt[2])
+            converted_amount = debt_amount.convert(rate, currency_paid)
 
             if remaining_amount >= converted_amount:
                 remaining_amount -= converted_amount
-                db.delete_debt(debt[0])
+                paid_debts.append(debt[0])
             else:
-                converted_remaining_debt = await get_exchange_rate(currency_paid, debt[2], remaining_amount, debt[3])
-                db.update_debt(debt[0], debt[1] - converted_remaining_debt)
-                remaining_amount = 0
-    
-    if remaining_amount > db.epsilon:
-        await message.reply(md.escape_md(texts.NOT_ALL_PAID[lang].format(remaining_amount, currency_paid)))
+                new_amount = debt_amount - remaining_amount.convert(1 / rate, debt[2])
+                if new_amount.minor > 0:
+                    updated_debts.append((debt[0], new_amount))
+                else:
+                    paid_debts.append(debt[0])
+                remaining_amount = Money.zero(currency_paid)
+
+    # в журнал и transactions идет только зачтенная часть: остаток никому не заплачен
+    applied_amount = amount_paid - remaining_amount
+    async with db.transaction():
+        if applied_amount.minor > 0:
+            await db.record_payment(debtor_id, creditor_id, applied_amount, message.chat.id)
+        for debt_id in paid_debts:
+            await db.delete_debt(debt_id)
+        for debt_id, new_amount in updated_debts:
+            await db.update_debt(debt_id, new_amount)
+
+    if conversion_failed:
+        await message.reply(texts.CONVERSION_ERROR.render(lang))
+    if remaining_amount.minor > 0:
+        await message.reply(texts.NOT_ALL_PAID.render(lang, remaining_amount.to_decimal(), currency_paid))
     else:
-        await message.reply(md.escape_md(texts.ALL_DEBTS_PAID[lang]))
+        await message.reply(texts.ALL_DEBTS_PAID.render(lang))
 
 
 @dp.message_handler(state=DebtPaymentStates.awaiting_payment)
 async def handle_payment_entry(message: types.Message, state: FSMContext):
-    lang = db.get_chat_lang(message.chat.id)
+    lang = await db.get_chat_lang(message.chat.id)
     try:
         amount_paid, currency_paid = message.text.split()
-        amount_paid = float(amount_paid)
+        amount_paid = Money.parse(amount_paid, currency_paid)
     except ValueError:
-        await message.reply(md.escape_md(texts.PAYMENT_FORMAT[lang]))
+        await message.reply(texts.PAYMENT_FORMAT.render(lang))
+        return
+    if currency_paid not in CURRENCY_EXCHANGE_OPTIONS:
+        await message.reply(texts.WRONG_CURRENCY.render(lang, ', '.join(CURRENCY_EXCHANGE_OPTIONS)))
+        return
+    if amount_paid.minor <= 0:
+        await message.reply(texts.PAYMENT_FORMAT.render(lang))
         return
 
-    await process_payment_logic(message, amount_paid, currency_paid, state)
+    await process_payment_logic(message, amount_paid, state)
     await state.finish()
 
 
+async def on_startup(dispatcher: Dispatcher):
+    rates_prefetcher.start()
+    send_scheduler.start()
+    reminder_scheduler.start()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    await rates_prefetcher.stop()
+    await reminder_scheduler.stop()
+    await send_scheduler.stop()
+
+
+async def on_webhook_startup(dispatcher: Dispatcher):
+    await on_startup(dispatcher)
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH)
+
+
+async def health(request: web.Request) -> web.Response:
+    # для балансировщика: процесс жив и база отвечает
+    try:
+        await db.ping()
+    except Exception as e:
+        return web.json_response({'status': 'error', 'error': str(e)}, status=503)
+    return web.json_response({
+        'status': 'ok',
+        'chat_queues': chat_serializer.stats(),
+        'send_queue': send_scheduler.stats(),
+        'chat_settings': db.chat_settings_stats(),
+    })
+
+
+def start_webhook(path=None, host=WEBAPP_HOST, port=WEBAPP_PORT, startup=on_webhook_startup):
+    app = web.Application()
+    app.router.add_get(HEALTH_PATH, health)
+    webhook = executor.set_webhook(dp, path or WEBHOOK_PATH, on_startup=startup, on_shutdown=on_shutdown, web_app=app)
+    # run_app по SIGINT/SIGTERM перестает принимать соединения, дожидается текущих запросов и
+    # вызывает on_shutdown; база закрывается в main() уже после этого
+    webhook.run_app(host=host, port=port)
+
+
+async def on_shard_startup(dispatcher: Dispatcher):
+    # курсы и напоминания в базе общие, поэтому ими занимается только нулевой шард
+    send_scheduler.start()
+
+
+def run_shard(index):
+    db.start()
+    try:
+        startup = on_startup if index == 0 else on_shard_startup
+        start_webhook(SHARD_PATH, '127.0.0.1', SHARD_BASE_PORT + index, startup)
+    finally:
+        db.finish()
+
+
+def start_sharded():
+    # миграции один раз до запуска шардов, иначе процессы начнут менять схему одновременно
+    db.migrate()
+    context = multiprocessing.get_context('spawn')
+    shards = [context.Process(target=run_shard, args=(index,), name=f"shard-{index}") for index in range(SHARDS)]
+    for shard in shards:
+        shard.start()
+
+    async def shards_health(request: web.Request) -> web.Response:
+        dead = [shard.name for shard in shards if not shard.is_alive()]
+        if dead:
+            return web.json_response({'status': 'error', 'dead': dead}, status=503)
+        return web.json_response({'status': 'ok'})
+
+    async def register_webhook(app):
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH)
+
+    async def stop_shards(app):
+        # SIGTERM: каждый шард сам доделывает текущие обновления и закрывает базу
+        for shard in shards:
+            shard.terminate()
+        loop = asyncio.get_running_loop()
+        for shard in shards:
+            await loop.run_in_executor(None, shard.join)
+        session = await bot.get_session()
+        await session.close()
+
+    app = web.Application()
+    ShardRouter([f"http://127.0.0.1:{SHARD_BASE_PORT + index}{SHARD_PATH}" for index in range(SHARDS)]).setup(app, WEBHOOK_PATH)
+    app.router.add_get(HEALTH_PATH, shards_health)
+    app.on_startup.append(register_webhook)
+    app.on_cleanup.append(stop_shards)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+
+
 def main():
+    if SHARDED:
+        start_sharded()
+        return
+
     db.start()
-    executor.start_polling(dp)
-    db.finish()
+    try:
+        if WEBHOOK_PATH:
+            start_webhook()
+        else:
+            executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    finally:
+        db.finish()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,39 @@
+from .chat_serializer import ChatSerializationMiddleware
 from .database import Database
+from .money import Money
 from .texts import *  # noqa
-from .exchange_rates_api import get_exchange_rate, CURRENCY_EXCHANGE_OPTIONS
+from .fsm_storage import SQLiteStorage
+from .exchange_rates_api import get_exchange_rate, get_exchange_rates, set_rate_provider, set_rates_pool, CURRENCY_EXCHANGE_OPTIONS
+from .rate_providers import FileRateProvider, YahooRateProvider
+from .rates_prefetcher import RatesPrefetcher
+from .sharding import ShardRouter, shard_for, update_chat_id
+from .reminder_scheduler import ReminderScheduler
+from .send_scheduler import SendScheduler, TokenBucket
+from .settlement import net_balances, sum_balances, settle, settle_exact, settle_greedy
 
 __all__ = [   # noqa
+    'ChatSerializationMiddleware',
     'Database',
+    'Money',
+    'SQLiteStorage',
     'texts',
     'get_exchange_rate',
+    'get_exchange_rates',
+    'set_rate_provider',
+    'set_rates_pool',
+    'FileRateProvider',
+    'YahooRateProvider',
+    'RatesPrefetcher',
+    'net_balances',
+    'sum_balances',
+    'settle',
+    'settle_exact',
+    'settle_greedy',
+    'ReminderScheduler',
+    'SendScheduler',
+    'TokenBucket',
+    'ShardRouter',
+    'shard_for',
+    'update_chat_id',
     'CURRENCY_EXCHANGE_OPTIONS'
 ]
\ No newline at end of file
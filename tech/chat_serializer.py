@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from .sharding import update_chat_id
+
+
+class ChatSerializationMiddleware(BaseMiddleware):
+    # обновления одного чата обрабатываются строго по очереди (asyncio.Lock будит ожидающих
+    # в порядке прихода), разные чаты - параллельно. Должен подключаться первым, чтобы
+    # очередь занималась до того, как другие middleware начнут ждать
+    def __init__(self):
+        super().__init__()
+        # {chat_id: [lock, обновлений в работе и в очереди]}; запись живет, пока у чата есть обновления
+        self.chats = {}
+        self.queued = 0
+        self.max_depth = 0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def setup(self, manager):
+        super().setup(manager)
+        # если pre_process следующего middleware упадет или отменит обновление (CancelHandler),
+        # aiogram не вызовет post_process, и очередь чата осталась бы занятой навсегда
+        trigger = manager.trigger
+
+        async def guarded_trigger(action, args):
+            try:
+                await trigger(action, args)
+            except BaseException:
+                if action == 'pre_process_update':
+                    self._release(args[0])
+                raise
+
+        manager.trigger = guarded_trigger
+
+    async def on_pre_process_update(self, update, data: dict):
+        chat_id = update_chat_id(update.to_python())
+        entry = self.chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        self.max_depth = max(self.max_depth, entry[1])
+
+        start = time.monotonic()
+        self.queued += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._leave(chat_id, entry)
+            raise
+        finally:
+            self.queued -= 1
+
+        wait_time = time.monotonic() - start
+        self.waits += 1
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+        update.conf['_chat_lock'] = chat_id
+
+    async def on_post_process_update(self, update, result, data: dict):
+        self._release(update)
+
+    def _release(self, update):
+        # отметка в update.conf снимается при первом освобождении, повторный вызов ничего не делает
+        if '_chat_lock' not in update.conf:
+            return
+        chat_id = update.conf.pop('_chat_lock')
+        entry = self.chats[chat_id]
+        entry[0].release()
+        self._leave(chat_id, entry)
+
+    def _leave(self, chat_id, entry):
+        entry[1] -= 1
+        if not entry[1]:
+            del self.chats[chat_id]
+
+    def queue_depth(self, chat_id):
+        # обновления чата, ожидающие своей очереди (без обрабатываемого сейчас)
+        entry = self.chats.get(chat_id)
+        return max(entry[1] - 1, 0) if entry else 0
+
+    def stats(self):
+        return {
+            'active_chats': len(self.chats),
+            'queued': self.queued,
+            'max_depth': self.max_depth,
+            'waits': self.waits,
+            'wait_time_avg': self.wait_time_total / self.waits if self.waits else 0.0,
+            'wait_time_max': self.wait_time_max,
+        }
@@ -0,0 +1,106 @@
+import asyncio
+import contextlib
+import contextvars
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+# WAL: читатели не ждут писателя; synchronous=NORMAL в WAL не теряет целостность, но делает
+# fsync только на чекпоинтах; cache_size в KiB (отрицательное значение), mmap_size в байтах
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16384",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# соединение открытой транзакции текущей задачи: все запросы внутри transaction() идут через него
+_transaction_connection = contextvars.ContextVar("transaction_connection", default=None)
+
+
+def _execute_statement(connection, sql):
+    connection.execute(sql)
+
+
+def _commit(connection):
+    connection.commit()
+
+
+def _rollback(connection):
+    connection.rollback()
+
+
+class ConnectionPool():
+    # sqlite3 блокирует поток на диске, поэтому каждый запрос выполняется в отдельном потоке
+    # на своем соединении из пула, а event loop только ждет результат
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self.connections = None
+        self.executor = None
+
+    def connect(self):
+        # isolation_level=None: вне transaction() каждый запрос коммитится сам
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    def open(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="db")
+        self.connections = asyncio.Queue()
+        for _ in range(self.size):
+            self.connections.put_nowait(self.connect())
+
+    async def _run_on(self, connection, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, connection, *args)
+
+    async def run(self, fn, *args):
+        # fn(connection, *args) выполняется в пуле потоков; соединение занято только на время вызова
+        connection = _transaction_connection.get()
+        if connection is not None:
+            return await self._run_on(connection, fn, *args)
+
+        return await self.run_detached(fn, *args)
+
+    async def run_detached(self, fn, *args):
+        # всегда на свободном соединении, вне транзакции текущей задачи: для фоновых задач,
+        # которые могут пережить транзакцию, внутри которой их создали
+        connection = await self.connections.get()
+        try:
+            return await self._run_on(connection, fn, *args)
+        finally:
+            self.connections.put_nowait(connection)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        # одна логическая операция - один коммит; вложенные transaction() становятся частью внешней
+        if _transaction_connection.get() is not None:
+            yield
+            return
+
+        connection = await self.connections.get()
+        token = _transaction_connection.set(connection)
+        try:
+            # IMMEDIATE сразу берет блокировку на запись, чтобы не получить SQLITE_BUSY посреди транзакции
+            await self._run_on(connection, _execute_statement, "BEGIN IMMEDIATE")
+            try:
+                yield
+                await self._run_on(connection, _commit)
+            except BaseException:
+                await self._run_on(connection, _rollback)
+                raise
+        finally:
+            _transaction_connection.reset(token)
+            self.connections.put_nowait(connection)
+
+    def close(self):
+        if self.connections is not None:
+            while not self.connections.empty():
+                self.connections.get_nowait().close()
+            self.connections = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
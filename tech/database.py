@@ -1,186 +1,683 @@
 import datetime
-import sqlite3
+import logging
+import time
+from collections import OrderedDict
 
-from .exchange_rates_api import get_exchange_rate
+from .connection_pool import ConnectionPool
+from .exchange_rates_api import get_exchange_rates, CURRENCY_EXCHANGE_OPTIONS
+from .fsm_storage import create_fsm_storage
+from .ledger import EXPENSE, PAYMENT, append_events, create_ledger, replay, seed_ledger
+from .money import Money
+from .rates_cache import create_exchange_rates
+from .reminders import claim_due, create_reminders, next_due, set_reminder
 
+logger = logging.getLogger(__name__)
 
-class Database():
-    def __init__(self):
-        self.connection = sqlite3.connect("database.db")
-        self.cursor = self.connection.cursor()
+DATABASE_PATH = "database.db"
+POOL_SIZE = 4
+BACKFILL_CHUNK_SIZE = 1000
+USER_DIRECTORY_SIZE = 1024
+CHAT_SETTINGS_CACHE_SIZE = 4096
+# при шардировании настройки чата меняет шард этого чата, а напоминания рассылает нулевой шард:
+# TTL ограничивает, сколько он может видеть устаревшее значение
+CHAT_SETTINGS_TTL = 300
+# настройки чата - колонки таблицы chats; новая настройка (например, валюта по умолчанию) -
+# это миграция с колонкой и ее имя здесь
+CHAT_SETTINGS = ('language',)
 
-        self.epsilon = 0.001
 
-    def start(self):
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, language VARCHAR(256) DEFAULT 'ru');"
+def _create_indexes(cursor):
+    # выборки долгов всегда идут по чату и паре кредитор/должник (+ валюта)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS debts_chat_creditor_debtor ON debts (chat_id, creditor_id, debtor_id, currency);"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS debts_chat_debtor_creditor ON debts (chat_id, debtor_id, creditor_id);"
+    )
+    # покрывающие индексы для списка пользователей чата и поиска по username
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS users_chat ON users (chat_id, user_id, username);"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS users_username ON users (username, user_id);"
+    )
+
+
+def _create_balances(cursor):
+    # чистый баланс пользователя в чате по валюте: сколько ему должны минус сколько должен он.
+    # Триггеры обновляют его в той же транзакции, что и любое изменение debts
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS balances (" +
+        "chat_id INTEGER NOT NULL," +
+        "user_id INTEGER NOT NULL," +
+        "currency VARCHAR(8) NOT NULL," +
+        "balance REAL NOT NULL DEFAULT 0," +
+        "PRIMARY KEY (chat_id, user_id, currency));"
+    )
+    _create_balance_triggers(cursor, "amount", "balance")
+
+
+def _create_balance_triggers(cursor, amount_column, balance_column):
+    for trigger, sign, row in (("insert", "+", "NEW"), ("delete", "-", "OLD")):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS debts_balances_{trigger} AFTER {trigger.upper()} ON debts
+            BEGIN
+                {_balance_upsert(row, sign, amount_column, balance_column)}
+            END;
+            """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS debts_balances_update AFTER UPDATE OF creditor_id, debtor_id, {amount_column}, currency, chat_id ON debts
+        BEGIN
+            {_balance_upsert("OLD", "-", amount_column, balance_column)}
+            {_balance_upsert("NEW", "+", amount_column, balance_column)}
+        END;
+        """)
+
+
+def _balance_upsert(row, sign, amount_column, balance_column):
+    opposite = "-" if sign == "+" else "+"
+    return f"""
+        INSERT INTO balances (chat_id, user_id, currency, {balance_column}) VALUES ({row}.chat_id, {row}.creditor_id, {row}.currency, {sign}{row}.{amount_column})
+        ON CONFLICT (chat_id, user_id, currency) DO UPDATE SET {balance_column} = {balance_column} {sign} {row}.{amount_column};
+        INSERT INTO balances (chat_id, user_id, currency, {balance_column}) VALUES ({row}.chat_id, {row}.debtor_id, {row}.currency, {opposite}{row}.{amount_column})
+        ON CONFLICT (chat_id, user_id, currency) DO UPDATE SET {balance_column} = {balance_column} {opposite} {row}.{amount_column};
+    """
+
+
+def _rebuild_balances(connection, chat_ids, amount_column="amount_minor", balance_column="balance_minor"):
+    # пересчитывает балансы чатов с нуля по текущим долгам (платежи в debts уже учтены)
+    placeholders = ", ".join("?" * len(chat_ids))
+    connection.execute(f"DELETE FROM balances WHERE chat_id IN ({placeholders})", chat_ids)
+    connection.execute(f"""
+        INSERT INTO balances (chat_id, user_id, currency, {balance_column})
+        SELECT chat_id, user_id, currency, SUM(delta) FROM (
+            SELECT chat_id, creditor_id AS user_id, currency, {amount_column} AS delta FROM debts WHERE chat_id IN ({placeholders})
+            UNION ALL
+            SELECT chat_id, debtor_id AS user_id, currency, -{amount_column} AS delta FROM debts WHERE chat_id IN ({placeholders})
         )
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS users (user_id INT, chat_id INT, username VARCHAR(256), phone_number VARCHAR(256) NOT NULL, preferred_bank VARCHAR(256)," +
-            "primary key (user_id, chat_id));"
+        GROUP BY chat_id, user_id, currency
+        """, (*chat_ids, *chat_ids))
+
+
+def _balance_mismatches(connection, chat_ids=None):
+    # [(chat_id, user_id, currency, в balances, по debts)] там, где триггеры разошлись с долгами;
+    # chat_ids=None - по всей базе
+    chat_filter, params = "", ()
+    if chat_ids is not None:
+        chat_filter = f"WHERE chat_id IN ({', '.join('?' * len(chat_ids))})"
+        params = tuple(chat_ids)
+    return connection.execute(f"""
+        SELECT chat_id, user_id, currency, SUM(stored), SUM(expected) FROM (
+            SELECT chat_id, user_id, currency, balance_minor AS stored, 0 AS expected FROM balances
+            UNION ALL
+            SELECT chat_id, creditor_id, currency, 0, amount_minor FROM debts
+            UNION ALL
+            SELECT chat_id, debtor_id, currency, 0, -amount_minor FROM debts
         )
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS debts (" +
-            "debt_id INTEGER PRIMARY KEY," +
-            "creditor_id INTEGER NOT NULL," +
-            "debtor_id INTEGER NOT NULL," +
-            "amount REAL NOT NULL," +
-            "currency INTEGER NOT NULL," +
-            "description TEXT," +
-            "date DATE NOT NULL," +
-            "chat_id INTEGER NOT NULL," +
-            "FOREIGN KEY (creditor_id) REFERENCES users (user_id)," +
-            "FOREIGN KEY (debtor_id) REFERENCES users (user_id)," +
-            "FOREIGN KEY (chat_id) REFERENCES chats (chat_id));"
+        {chat_filter}
+        GROUP BY chat_id, user_id, currency
+        HAVING SUM(stored) != SUM(expected)
+        """, params).fetchall()
+
+
+def repair_balances(connection):
+    # -> chat_id, чьи балансы пришлось пересобрать; запускается после миграций при каждом старте
+    chat_ids = sorted({row[0] for row in _balance_mismatches(connection)})
+    if chat_ids:
+        logger.warning("Balances out of sync with debts in %d chats, rebuilding: %s", len(chat_ids), chat_ids)
+        connection.execute("BEGIN")
+        _rebuild_balances(connection, chat_ids)
+        connection.commit()
+    return chat_ids
+
+
+def _backfill_balances_v2(connection):
+    _backfill_balances(connection, lambda connection, chat_ids: _rebuild_balances(connection, chat_ids, "amount", "balance"))
+
+
+def _backfill_balances(connection, rebuild=_rebuild_balances, chunk_size=BACKFILL_CHUNK_SIZE):
+    last_chat_id = None
+    while True:
+        chat_ids = [row[0] for row in connection.execute(
+            "SELECT DISTINCT chat_id FROM debts WHERE ? IS NULL OR chat_id > ? ORDER BY chat_id LIMIT ?",
+            (last_chat_id, last_chat_id, chunk_size)
+        )]
+        if not chat_ids:
+            break
+
+        connection.execute("BEGIN")
+        rebuild(connection, chat_ids)
+        connection.commit()
+        last_chat_id = chat_ids[-1]
+
+
+def _create_chat_debts_index(cursor):
+    # (chat_id, rowid): долги чата по возрастанию debt_id для постраничного вывода без сортировки;
+    # то же для страниц долгов одного кредитора или должника - индексы неявно заканчиваются на rowid
+    cursor.execute("CREATE INDEX IF NOT EXISTS debts_chat ON debts (chat_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debts_chat_creditor ON debts (chat_id, creditor_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS debts_chat_debtor ON debts (chat_id, debtor_id);")
+
+
+def _has_column(cursor, table, column):
+    return any(row[1] == column for row in cursor.execute(f"PRAGMA table_info({table})"))
+
+
+def _add_column(cursor, table, column, definition):
+    # ADD COLUMN не поддерживает IF NOT EXISTS: базы, где шаг схемы успел выполниться
+    # до падения (до того, как migrate стал отмечать его отдельно), уже содержат колонку
+    if not _has_column(cursor, table, column):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _add_minor_units(cursor):
+    # суммы переезжают в целые минимальные единицы валюты; старые триггеры считали по REAL,
+    # новые создаются следующей миграцией, когда новые колонки уже заполнены
+    _add_column(cursor, "debts", "amount_minor", "INTEGER")
+    _add_column(cursor, "transactions", "amount_paid_minor", "INTEGER")
+    _add_column(cursor, "ledger", "amount_minor", "INTEGER")
+    _add_column(cursor, "balances", "balance_minor", "INTEGER NOT NULL DEFAULT 0")
+    for trigger in ("insert", "delete", "update"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS debts_balances_{trigger}")
+    # снимки журнала хранили суммы в REAL и пересоберутся при следующем replay
+    cursor.execute("DELETE FROM ledger_snapshots")
+
+
+def _backfill_minor_units(connection):
+    def to_minor(row):
+        return (Money.parse(row[1], row[2]).minor, row[0])
+
+    backfill(connection, "debts", "amount, currency", "UPDATE debts SET amount_minor = ? WHERE rowid = ?", to_minor)
+    backfill(connection, "transactions", "amount_paid, currency", "UPDATE transactions SET amount_paid_minor = ? WHERE rowid = ?", to_minor)
+    backfill(connection, "ledger", "amount, currency", "UPDATE ledger SET amount_minor = ? WHERE rowid = ?", to_minor)
+
+
+def _create_minor_balance_triggers(cursor):
+    _create_balance_triggers(cursor, "amount_minor", "balance_minor")
+
+
+def _drop_real_amounts(cursor):
+    cursor.execute("ALTER TABLE debts DROP COLUMN amount")
+    cursor.execute("ALTER TABLE transactions DROP COLUMN amount_paid")
+    cursor.execute("ALTER TABLE ledger DROP COLUMN amount")
+    cursor.execute("ALTER TABLE balances DROP COLUMN balance")
+
+
+# (версия, изменение схемы в транзакции, бэкфилл данных кусками или None) - строго по возрастанию версий
+MIGRATIONS = [
+    (1, _create_indexes, None),
+    (2, _create_balances, _backfill_balances_v2),
+    (3, create_ledger, seed_ledger),
+    (4, _add_minor_units, _backfill_minor_units),
+    (5, _create_minor_balance_triggers, _backfill_balances),
+    (6, _drop_real_amounts, None),
+    (7, create_fsm_storage, None),
+    (8, create_reminders, None),
+    (9, _create_chat_debts_index, None),
+    (10, create_exchange_rates, None),
+]
+
+
+def _create_tables(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, language VARCHAR(256) DEFAULT 'ru');"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS users (user_id INT, chat_id INT, username VARCHAR(256), phone_number VARCHAR(256) NOT NULL, preferred_bank VARCHAR(256)," +
+        "primary key (user_id, chat_id));"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS debts (" +
+        "debt_id INTEGER PRIMARY KEY," +
+        "creditor_id INTEGER NOT NULL," +
+        "debtor_id INTEGER NOT NULL," +
+        "amount REAL NOT NULL," +
+        "currency INTEGER NOT NULL," +
+        "description TEXT," +
+        "date DATE NOT NULL," +
+        "chat_id INTEGER NOT NULL," +
+        "FOREIGN KEY (creditor_id) REFERENCES users (user_id)," +
+        "FOREIGN KEY (debtor_id) REFERENCES users (user_id)," +
+        "FOREIGN KEY (chat_id) REFERENCES chats (chat_id));"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS transactions (" +
+        "transaction_id INTEGER PRIMARY KEY," +
+        "creditor_id INTEGER NOT NULL," +
+        "debtor_id INTEGER NOT NULL," +
+        "amount_paid REAL NOT NULL," +
+        "currency INTEGER NOT NULL," +
+        "date DATE NOT NULL," +
+        "chat_id INTEGER NOT NULL," +
+        "FOREIGN KEY (creditor_id) REFERENCES users (user_id)," +
+        "FOREIGN KEY (debtor_id) REFERENCES users (user_id)," +
+        "FOREIGN KEY (chat_id) REFERENCES chats (chat_id));"
+    )
+
+
+def _create_schema_version(connection):
+    # backfill_done = 0: схема версии уже применена, бэкфилл еще не закончен
+    connection.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL, backfill_done INTEGER NOT NULL DEFAULT 1);")
+    if not _has_column(connection, "schema_version", "backfill_done"):
+        connection.execute("ALTER TABLE schema_version ADD COLUMN backfill_done INTEGER NOT NULL DEFAULT 1")
+
+
+def get_schema_version(connection):
+    _create_schema_version(connection)
+    result = connection.execute("SELECT MAX(version) FROM schema_version WHERE backfill_done").fetchone()
+    return result[0] or 0
+
+
+def migrate(connection):
+    _create_schema_version(connection)
+    applied = dict(connection.execute("SELECT version, backfill_done FROM schema_version"))
+    for version, apply_schema, backfill_data in MIGRATIONS:
+        if applied.get(version):
+            continue
+
+        if version not in applied:
+            # DDL в sqlite3 не открывает транзакцию сам, поэтому BEGIN явно; версия пишется
+            # в той же транзакции, что и схема, поэтому шаг схемы выполняется ровно один раз
+            cursor = connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                apply_schema(cursor)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, backfill_done) VALUES (?, ?)",
+                    (version, int(backfill_data is None))
+                )
+            except Exception:
+                connection.rollback()
+                raise
+            connection.commit()
+
+        if backfill_data is None:
+            continue
+
+        # бэкфилл идет кусками в отдельных транзакциях, чтобы не держать долгую блокировку,
+        # и должен быть идемпотентным: если процесс упадет посреди него, при следующем запуске
+        # повторится только бэкфилл
+        backfill_data(connection)
+        connection.execute("UPDATE schema_version SET backfill_done = 1 WHERE version = ?", (version,))
+        connection.commit()
+
+
+def backfill(connection, table, columns, update_sql, transform, chunk_size=BACKFILL_CHUNK_SIZE):
+    # проходит таблицу по rowid кусками по chunk_size строк; transform(row) возвращает
+    # параметры для update_sql или None, если строку трогать не нужно
+    last_rowid = 0
+    while True:
+        rows = connection.execute(
+            f"SELECT rowid, {columns} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+
+        params = [p for p in map(transform, rows) if p is not None]
+        if params:
+            connection.execute("BEGIN")
+            connection.executemany(update_sql, params)
+            connection.commit()
+        last_rowid = rows[-1][0]
+
+
+def _fetchone(connection, sql, params):
+    return connection.execute(sql, params).fetchone()
+
+
+def _fetchall(connection, sql, params):
+    return connection.execute(sql, params).fetchall()
+
+
+def _execute(connection, sql, params):
+    connection.execute(sql, params)
+
+
+def _debts_page_query(chat_id, debts_filter, user_id, after, before, limit):
+    # -> (sql, params) страницы для Database.get_debts_page; при before строки идут от новых к старым
+    conditions, params = ["chat_id = ?"], [chat_id]
+    if debts_filter in ('creditor', 'debtor'):
+        conditions.append(f"{debts_filter}_id = ?")
+        params.append(user_id)
+    if before is not None:
+        conditions.append("debt_id < ?")
+        params.append(before)
+    elif after is not None:
+        conditions.append("debt_id > ?")
+        params.append(after)
+    order = "DESC" if before is not None else "ASC"
+    return (
+        f"SELECT debt_id, debtor_id, creditor_id, amount_minor, currency, date FROM debts WHERE {' AND '.join(conditions)} ORDER BY debt_id {order} LIMIT ?",
+        (*params, limit)
+    )
+
+
+def _fetch_pair_debts(connection, chat_id, creditor_id, user_ids):
+    # {user_id: (amount_minor, debt_id, creditor_id, debtor_id, currency)} - долг между creditor_id и user_id
+    # в любую сторону, первый по debt_id, если их несколько
+    placeholders = ", ".join("?" * len(user_ids))
+    rows = connection.execute(f"""
+        SELECT amount_minor, debt_id, creditor_id, debtor_id, currency FROM debts
+        WHERE (chat_id = ? AND creditor_id = ? AND debtor_id IN ({placeholders}))
+        OR (chat_id = ? AND debtor_id = ? AND creditor_id IN ({placeholders}))
+        ORDER BY debt_id
+        """, (chat_id, creditor_id, *user_ids, chat_id, creditor_id, *user_ids)).fetchall()
+
+    debts = {}
+    for row in rows:
+        other_id = row[3] if row[2] == creditor_id else row[2]
+        debts.setdefault(other_id, row)
+    return debts
+
+
+def _write_debts(connection, inserts, updates, deletes):
+    if inserts:
+        connection.executemany(
+            "INSERT INTO debts (creditor_id, debtor_id, amount_minor, currency, description, date, chat_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            inserts
         )
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS transactions (" +
-            "transaction_id INTEGER PRIMARY KEY," +
-            "creditor_id INTEGER NOT NULL," +
-            "debtor_id INTEGER NOT NULL," +
-            "amount_paid REAL NOT NULL," +
-            "currency INTEGER NOT NULL," +
-            "date DATE NOT NULL," +
-            "chat_id INTEGER NOT NULL," +
-            "FOREIGN KEY (creditor_id) REFERENCES users (user_id)," +
-            "FOREIGN KEY (debtor_id) REFERENCES users (user_id)," +
-            "FOREIGN KEY (chat_id) REFERENCES chats (chat_id));"
+    if updates:
+        connection.executemany(
+            "UPDATE debts SET amount_minor = ?, creditor_id = ?, debtor_id = ?, currency = ? WHERE debt_id = ?",
+            updates
         )
+    if deletes:
+        connection.executemany("DELETE FROM debts WHERE debt_id = ?", deletes)
+
+
+class Database():
+    def __init__(self, path=DATABASE_PATH, pool_size=POOL_SIZE):
+        self.path = path
+        self.pool = ConnectionPool(path, pool_size)
+        # chat_id -> {user_id: username}, сбрасывается при регистрации пользователя в чате
+        self.user_directory = OrderedDict()
+        # chat_id -> (истекает, {настройка: значение}); запись обновляется при изменении настроек
+        self.chat_settings = OrderedDict()
+        self.chat_settings_hits = 0
+        self.chat_settings_misses = 0
+
+    def migrate(self):
+        connection = self.pool.connect()
+        try:
+            _create_tables(connection.cursor())
+            connection.commit()
+            migrate(connection)
+            repair_balances(connection)
+        finally:
+            connection.close()
 
-    def register_chat(self, chat_id):
-        self.connection.execute(
+    def start(self):
+        self.migrate()
+        self.pool.open()
+
+    async def _fetchone(self, sql, params=()):
+        return await self.pool.run(_fetchone, sql, params)
+
+    async def _fetchall(self, sql, params=()):
+        return await self.pool.run(_fetchall, sql, params)
+
+    async def _execute(self, sql, params=()):
+        await self.pool.run(_execute, sql, params)
+
+    def transaction(self):
+        return self.pool.transaction()
+
+    async def register_chat(self, chat_id):
+        await self._execute(
             "INSERT OR IGNORE INTO chats (chat_id) VALUES (?)",
             (chat_id,)
         )
-        self.connection.commit()
 
-    def get_chat_lang(self, chat_id):
-        self.cursor.execute("SELECT language FROM chats WHERE chat_id = ?", (chat_id,))
-        result = self.cursor.fetchone()
-        return result[0] if result else None
-    
-    def update_chat_lang(self, chat_id, lang):
-        self.cursor.execute("UPDATE chats SET language = ? WHERE chat_id = ?", (lang, chat_id,))
-        self.connection.commit()
+    async def get_chat_settings(self, chat_id):
+        # -> {настройка: значение} или None, если чат не зарегистрирован (такое не кешируется)
+        entry = self.chat_settings.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.chat_settings.move_to_end(chat_id)
+            self.chat_settings_hits += 1
+            return entry[1]
 
-    def register_user(self, message, phone, bank):
-        self.connection.execute(
+        self.chat_settings_misses += 1
+        result = await self._fetchone(f"SELECT {', '.join(CHAT_SETTINGS)} FROM chats WHERE chat_id = ?", (chat_id,))
+        if result is None:
+            self.chat_settings.pop(chat_id, None)
+            return None
+        settings = dict(zip(CHAT_SETTINGS, result))
+        self.chat_settings[chat_id] = (time.monotonic() + CHAT_SETTINGS_TTL, settings)
+        self.chat_settings.move_to_end(chat_id)
+        while len(self.chat_settings) > CHAT_SETTINGS_CACHE_SIZE:
+            self.chat_settings.popitem(last=False)
+        return settings
+
+    async def get_chat_setting(self, chat_id, name):
+        settings = await self.get_chat_settings(chat_id)
+        return settings[name] if settings else None
+
+    async def update_chat_setting(self, chat_id, name, value):
+        if name not in CHAT_SETTINGS:
+            raise ValueError(f"Unknown chat setting: {name}")
+        await self._execute(f"UPDATE chats SET {name} = ? WHERE chat_id = ?", (value, chat_id))
+        entry = self.chat_settings.get(chat_id)
+        if entry is not None:
+            entry[1][name] = value
+
+    def chat_settings_stats(self):
+        # hits - сколько запросов к базе сэкономил кеш
+        return {
+            'size': len(self.chat_settings),
+            'hits': self.chat_settings_hits,
+            'misses': self.chat_settings_misses,
+        }
+
+    async def get_chat_lang(self, chat_id):
+        return await self.get_chat_setting(chat_id, 'language')
+
+    async def update_chat_lang(self, chat_id, lang):
+        await self.update_chat_setting(chat_id, 'language', lang)
+
+    async def register_user(self, message, phone, bank):
+        await self._execute(
             "INSERT INTO users (user_id, chat_id, username, phone_number, preferred_bank) VALUES (?, ?, ?, ?, ?)",
             (message.from_user.id, message.chat.id, message.from_user.username, phone, bank)
         )
-        self.connection.commit()
+        self.user_directory.pop(message.chat.id, None)
+
+    async def get_users_in_chat(self, chat_id):
+        directory = self.user_directory.get(chat_id)
+        if directory is None:
+            rows = await self._fetchall("SELECT user_id, username FROM users WHERE chat_id = ?", (chat_id,))
+            directory = dict(rows)
+            self.user_directory[chat_id] = directory
+            while len(self.user_directory) > USER_DIRECTORY_SIZE:
+                self.user_directory.popitem(last=False)
+        else:
+            self.user_directory.move_to_end(chat_id)
+        return list(directory.items())
 
-    def get_users_in_chat(self, chat_id):
-        self.cursor.execute("SELECT user_id, username FROM users WHERE chat_id = ?", (chat_id,))
-        return self.cursor.fetchall()
+    async def get_usernames(self, chat_id, user_ids):
+        # {user_id: username} для всех user_ids: сначала из справочника чата, остальные одним запросом
+        usernames = dict(await self.get_users_in_chat(chat_id))
+        missing = list({user_id for user_id in user_ids if user_id not in usernames})
+        if missing:
+            placeholders = ", ".join("?" * len(missing))
+            usernames.update(await self._fetchall(
+                f"SELECT user_id, username FROM users WHERE user_id IN ({placeholders})",
+                missing
+            ))
+        return usernames
 
     async def update_or_add_debt(self, creditor_id, debtor_id, amount, currency, description, chat_id):
-        if creditor_id == debtor_id:
+        await self.apply_expense_split(creditor_id, {debtor_id: amount}, currency, description, chat_id)
+
+    async def apply_expense_split(self, creditor_id, shares, currency, description, chat_id):
+        # shares: {debtor_id: Money в валюте currency}; все пары читаются одним запросом и пишутся одной транзакцией
+        shares = {debtor_id: amount for debtor_id, amount in shares.items() if debtor_id != creditor_id}
+        if not shares:
             return
 
-        self.cursor.execute("""
-            SELECT amount, debt_id, creditor_id, currency FROM debts 
-            WHERE ((creditor_id = ? AND debtor_id = ?) OR (creditor_id = ? AND debtor_id = ?))
-            AND chat_id = ?
-            """, (creditor_id, debtor_id, debtor_id, creditor_id, chat_id))
-        result = self.cursor.fetchone()
-
-        if result:
-            current_amount, debt_id, current_creditor_id, current_currency = result
-            if current_currency != currency:
-                amount = await get_exchange_rate(currency, current_currency, amount, str(datetime.datetime.now(tz=datetime.timezone.utc)))
-                currency = current_currency
-
-            if creditor_id == current_creditor_id:
-                new_amount = current_amount + amount
-            else:
-                new_amount = current_amount - amount
-                if new_amount < 0:
-                    new_amount = -new_amount
-                    debtor_id = current_creditor_id
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        # курсы нужны, только если у пары уже есть долг в другой валюте; сеть - до начала транзакции
+        rates = {currency: 1.0}
+        current_debts = await self.pool.run(_fetch_pair_debts, chat_id, creditor_id, list(shares))
+        if any(debt[4] != currency for debt in current_debts.values()):
+            targets = [other for other in CURRENCY_EXCHANGE_OPTIONS if other != currency]
+            resolved = await get_exchange_rates((currency, other, str(now)) for other in targets)
+            rates.update(zip(targets, resolved))
+
+        async with self.transaction():
+            current_debts = await self.pool.run(_fetch_pair_debts, chat_id, creditor_id, list(shares))
+
+            inserts, updates, deletes = [], [], []
+            for debtor_id, amount in shares.items():
+                current = current_debts.get(debtor_id)
+                if current is None:
+                    inserts.append((creditor_id, debtor_id, amount.minor, currency, description, now, chat_id))
+                    continue
+
+                current_minor, debt_id, current_creditor_id, current_debtor_id, current_currency = current
+                if rates.get(current_currency) is None:
+                    raise ValueError(f"No exchange rate for {currency} -> {current_currency}")
+                if current_currency != currency:
+                    amount = amount.convert(rates[current_currency], current_currency)
+                current_amount = Money(current_minor, current_currency)
+
+                if creditor_id == current_creditor_id:
+                    new_amount = current_amount + amount
+                    new_creditor_id, new_debtor_id = creditor_id, debtor_id
                 else:
-                    debtor_id = creditor_id
-                    creditor_id = current_creditor_id
+                    new_amount = current_amount - amount
+                    new_creditor_id, new_debtor_id = current_creditor_id, creditor_id
+                    if new_amount.minor < 0:
+                        new_amount = -new_amount
+                        new_creditor_id, new_debtor_id = creditor_id, current_creditor_id
 
-            if abs(new_amount) > self.epsilon:
-                self.cursor.execute("UPDATE debts SET amount = ?, creditor_id = ?, debtor_id = ?, currency = ? WHERE debt_id = ?", (round(new_amount, 3), creditor_id, debtor_id, currency, debt_id))
-            else:
-                self.cursor.execute("DELETE FROM debts WHERE debt_id = ?", (debt_id,))
-        else:
-            self.cursor.execute("INSERT INTO debts (creditor_id, debtor_id, amount, currency, description, date, chat_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (creditor_id, debtor_id, round(amount, 3), currency, description, datetime.datetime.now(tz=datetime.timezone.utc), chat_id))
-        self.connection.commit()
+                if new_amount:
+                    updates.append((new_amount.minor, new_creditor_id, new_debtor_id, current_currency, debt_id))
+                else:
+                    deletes.append((debt_id,))
 
-    def get_user_contact_info(self, chat_id, user_id):
-        self.cursor.execute("SELECT phone_number, preferred_bank FROM users WHERE chat_id = ? and user_id = ?", (chat_id, user_id,))
-        result = self.cursor.fetchone()
+            await self.pool.run(_write_debts, inserts, updates, deletes)
+            await self.pool.run(append_events, [
+                (chat_id, EXPENSE, creditor_id, debtor_id, amount.minor, currency, description, now)
+                for debtor_id, amount in shares.items()
+            ])
+
+    async def get_user_contact_info(self, chat_id, user_id):
+        result = await self._fetchone("SELECT phone_number, preferred_bank FROM users WHERE chat_id = ? and user_id = ?", (chat_id, user_id,))
         return result[0], result[1] if result else None
 
-    def get_user_id_by_username(self, username):
-        self.cursor.execute("SELECT user_id FROM users WHERE username = ?", (username,))
-        result = self.cursor.fetchone()
+    async def get_user_id_by_username(self, username):
+        result = await self._fetchone("SELECT user_id FROM users WHERE username = ?", (username,))
         return result[0] if result else None
-    
-    def get_username_by_user_id(self, user_id):
-        self.cursor.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-        result = self.cursor.fetchone()
+
+    async def get_username_by_user_id(self, user_id):
+        result = await self._fetchone("SELECT username FROM users WHERE user_id = ?", (user_id,))
         return result[0] if result else None
-    
-    def get_debts_from_chat(self, chat_id):
-        self.cursor.execute(
-            "SELECT debt_id, debtor_id, creditor_id, amount, currency, date FROM debts WHERE chat_id = ?",
+
+    async def get_debts_from_chat(self, chat_id):
+        return await self._fetchall(
+            "SELECT debt_id, debtor_id, creditor_id, amount_minor, currency, date FROM debts WHERE chat_id = ?",
             (chat_id,)
         )
-        return self.cursor.fetchall()
-    
-    def get_debts_for_pair(self, chat_id, creditor_id, debtor_id):
-        self.cursor.execute(
-            "SELECT debt_id, debtor_id, creditor_id, amount, currency, date FROM debts WHERE chat_id = ? and creditor_id = ? and debtor_id = ? ",
+
+    async def get_debts_for_pair(self, chat_id, creditor_id, debtor_id):
+        return await self._fetchall(
+            "SELECT debt_id, debtor_id, creditor_id, amount_minor, currency, date FROM debts WHERE chat_id = ? and creditor_id = ? and debtor_id = ? ",
             (chat_id, creditor_id, debtor_id)
         )
-        return self.cursor.fetchall()
 
-    def get_debts_by_debtor_id(self, chat_id, debtor_id):
-        self.cursor.execute(
-            "SELECT debt_id, debtor_id, creditor_id, amount, currency, date FROM debts WHERE chat_id = ? and debtor_id = ?",
+    async def get_debts_by_debtor_id(self, chat_id, debtor_id):
+        return await self._fetchall(
+            "SELECT debt_id, debtor_id, creditor_id, amount_minor, currency, date FROM debts WHERE chat_id = ? and debtor_id = ?",
             (chat_id, debtor_id)
         )
-        return self.cursor.fetchall()
-    
-    def get_debts_by_creditor_id(self, chat_id, creditor_id):
-        self.cursor.execute(
-            "SELECT debt_id, debtor_id, creditor_id, amount, currency, date FROM debts WHERE chat_id = ? and creditor_id = ?",
+
+    async def get_debts_by_creditor_id(self, chat_id, creditor_id):
+        return await self._fetchall(
+            "SELECT debt_id, debtor_id, creditor_id, amount_minor, currency, date FROM debts WHERE chat_id = ? and creditor_id = ?",
             (chat_id, creditor_id)
         )
-        return self.cursor.fetchall()
-    
-    def register_transaction(self, debtor_id, creditor_id, amount_paid, currency_paid, chat_id):
-        self.cursor.execute("INSERT INTO transactions (creditor_id, debtor_id, amount_paid, currency, date, chat_id) VALUES (?, ?, ?, ?, ?, ?)",
-                (creditor_id, debtor_id, amount_paid, currency_paid, datetime.datetime.now(tz=datetime.timezone.utc), chat_id))
-        self.connection.commit()
-
-    def delete_debt(self, debt_id):
-        self.cursor.execute("DELETE FROM debts WHERE debt_id = ?", (debt_id,))
-        self.connection.commit()
-
-    def update_debt(self, debt_id, new_debt_amount):
-        self.cursor.execute("UPDATE debts SET amount = ? WHERE debt_id = ?", (round(new_debt_amount, 3), debt_id))
-        self.connection.commit()
-
-    def get_debts_by_currency(self, chat_id, debtor_id, creditor_id, currency):
-        self.cursor.execute(
-            "SELECT debt_id, amount FROM debts WHERE chat_id = ? and creditor_id = ? and debtor_id = ? and currency = ?",
+
+    async def get_debts_page(self, chat_id, debts_filter, user_id, after=None, before=None, limit=20):
+        # страница долгов по ключу debt_id: after - следующие за ним, before - предыдущие;
+        # debts_filter: 'chat' - все долги чата, 'creditor'/'debtor' - долги, где user_id кредитор/должник
+        rows = await self._fetchall(*_debts_page_query(chat_id, debts_filter, user_id, after, before, limit))
+        return rows[::-1] if before is not None else rows
+
+    async def get_debt_currency_days(self):
+        return await self._fetchall("SELECT DISTINCT currency, substr(date, 1, 10) FROM debts")
+
+    async def register_transaction(self, debtor_id, creditor_id, amount_paid, chat_id):
+        await self._execute("INSERT INTO transactions (creditor_id, debtor_id, amount_paid_minor, currency, date, chat_id) VALUES (?, ?, ?, ?, ?, ?)",
+                (creditor_id, debtor_id, amount_paid.minor, amount_paid.currency, datetime.datetime.now(tz=datetime.timezone.utc), chat_id))
+
+    async def record_payment(self, debtor_id, creditor_id, amount_paid, chat_id):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        async with self.transaction():
+            await self.register_transaction(debtor_id, creditor_id, amount_paid, chat_id)
+            await self.pool.run(append_events, [(chat_id, PAYMENT, creditor_id, debtor_id, amount_paid.minor, amount_paid.currency, None, now)])
+
+    async def replay_ledger(self, chat_id):
+        # -> ({(user_a, user_b, currency): сумма}, версия журнала), долги в исходных валютах
+        return await self.pool.run(replay, chat_id)
+
+    async def get_ledger_version(self, chat_id):
+        result = await self._fetchone("SELECT MAX(event_id) FROM ledger WHERE chat_id = ?", (chat_id,))
+        return result[0] or 0
+
+    async def delete_debt(self, debt_id):
+        await self._execute("DELETE FROM debts WHERE debt_id = ?", (debt_id,))
+
+    async def update_debt(self, debt_id, new_debt_amount):
+        await self._execute("UPDATE debts SET amount_minor = ? WHERE debt_id = ?", (new_debt_amount.minor, debt_id))
+
+    async def get_debts_by_currency(self, chat_id, debtor_id, creditor_id, currency):
+        return await self._fetchall(
+            "SELECT debt_id, amount_minor FROM debts WHERE chat_id = ? and creditor_id = ? and debtor_id = ? and currency = ?",
             (chat_id, creditor_id, debtor_id, currency)
         )
-        return self.cursor.fetchall()
-    
-    def get_other_currency_debts(self, chat_id, debtor_id, creditor_id, currency):
-        self.cursor.execute(
-            "SELECT debt_id, amount, currency, date FROM debts WHERE chat_id = ? and creditor_id = ? and debtor_id = ? and currency != ?",
+
+    async def get_other_currency_debts(self, chat_id, debtor_id, creditor_id, currency):
+        return await self._fetchall(
+            "SELECT debt_id, amount_minor, currency, date FROM debts WHERE chat_id = ? and creditor_id = ? and debtor_id = ? and currency != ?",
             (chat_id, creditor_id, debtor_id, currency)
         )
-        return self.cursor.fetchall()
+
+    async def get_balances(self, chat_id):
+        return await self._fetchall(
+            "SELECT user_id, currency, balance_minor FROM balances WHERE chat_id = ? AND balance_minor != 0",
+            (chat_id,)
+        )
+
+    async def check_balances(self, chat_id):
+        # [(user_id, currency, в balances, по debts)] для расхождений
+        rows = await self.pool.run(_balance_mismatches, [chat_id])
+        return [row[1:] for row in rows]
+
+    async def rebuild_balances(self, chat_id):
+        async with self.transaction():
+            await self.pool.run(_rebuild_balances, [chat_id])
+
+    async def set_reminder(self, chat_id, interval_seconds):
+        await self.pool.run(set_reminder, chat_id, interval_seconds)
+
+    async def delete_reminder(self, chat_id):
+        await self._execute("DELETE FROM reminders WHERE chat_id = ?", (chat_id,))
+
+    async def get_reminder_interval(self, chat_id):
+        result = await self._fetchone("SELECT interval_seconds FROM reminders WHERE chat_id = ?", (chat_id,))
+        return result[0] if result else None
+
+    async def claim_due_reminders(self, now, limit):
+        async with self.transaction():
+            return await self.pool.run(claim_due, now, limit)
+
+    async def get_next_reminder_due(self):
+        return await self.pool.run(next_due)
+
+    async def ping(self):
+        await self._fetchone("SELECT 1", ())
 
     def finish(self):
-        self.cursor.close()
-        self.connection.close()
+        self.pool.close()
@@ -1,32 +1,133 @@
-from datetime import datetime, timedelta
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-import yfinance as yf
+from .rate_providers import BASE_CURRENCY, YahooRateProvider, lookup_rates
+from .rates_cache import RatesCache
 
 CURRENCY_EXCHANGE_OPTIONS = ['USD', 'EUR', 'RUB']
 
+# провайдеры ходят в сеть синхронно, поэтому запросы уходят в отдельный пул потоков
+FETCH_WORKERS = 4
+FETCH_TIMEOUT = 15
 
-async def get_exchange_rate(currency_from: str, currency_to: str, amount: float, date_str):
-    if (currency_from not in CURRENCY_EXCHANGE_OPTIONS) or (currency_to not in CURRENCY_EXCHANGE_OPTIONS):
-        return None
-    
-    rub_flag = False
-    if currency_from == "RUB":
-        currency_from, currency_to = currency_to, currency_from
-        rub_flag = True
-    
+rates_cache = RatesCache()
+rate_provider = YahooRateProvider(timeout=FETCH_TIMEOUT)
+
+_fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="rates")
+_fetch_semaphore = asyncio.Semaphore(FETCH_WORKERS)
+
+
+def set_rate_provider(provider):
+    global rate_provider
+    rate_provider = provider
+
+
+def set_rates_pool(pool):
+    # кэш курсов хранится в базе бота и ходит в нее через ее пул соединений
+    rates_cache.bind(pool)
+
+
+def _parse_date(date_str):
     try:
-        date = datetime.strptime(date_str[:10], "%Y-%m-%d")
+        return datetime.strptime(date_str[:10], "%Y-%m-%d")
     except Exception as e:
         raise ValueError("Date should be formatted as YYYY-MM-DD")
-    # нужны данные за ближайший к date рабочий день (возможно сам date)
-    prefix_date = date - timedelta(days=10)
 
-    ticker = yf.Ticker(f"{currency_from+currency_to}=X")
-    hist = ticker.history(interval='15m', start=prefix_date, end=date)
-    exchange_rate = hist.iloc[-1]['Open']
-    #print(f"Last available data up to the given date from: {hist.iloc[-1].name.date()}")
 
-    if rub_flag:
-        exchange_rate = 1 / exchange_rate
+async def _fetch_daily_rates(currency, start: datetime, end: datetime):
+    # одна валюта - одна загрузка со своим таймаутом; слот пула освобождается, когда поток
+    # действительно закончил, а не по таймауту, иначе зависшие загрузки копятся в очереди пула
+    await _fetch_semaphore.acquire()
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_fetch_executor, rate_provider.get_daily_rates, [currency], start, end)
+    future.add_done_callback(lambda _: _fetch_semaphore.release())
+    return await asyncio.wait_for(asyncio.shield(future), FETCH_TIMEOUT)
+
+
+async def _get_base_rates(days_by_currency, track=True):
+    # days_by_currency: {currency: {day}} -> {(currency, day): курс к BASE_CURRENCY}
+    base_rates = {}
+    keys = []
+    for currency, days in days_by_currency.items():
+        for day in days:
+            if currency == BASE_CURRENCY:
+                base_rates[(currency, day)] = 1.0
+            else:
+                keys.append((BASE_CURRENCY, currency, day))
+
+    cached = await rates_cache.get_many(keys, track=track)
+    missing = defaultdict(set)
+    for key in keys:
+        rate = cached.get(key)
+        if rate is None:
+            missing[key[1]].add(key[2])
+        else:
+            base_rates[key[1:]] = rate
+
+    if not missing:
+        return base_rates
+
+    # валюты загружаются параллельно, и каждая кэшируется, как только пришла:
+    # медленная или недоступная валюта не отменяет остальные
+    async def resolve_currency(currency, days):
+        days = sorted(days)
+        try:
+            table = await _fetch_daily_rates(currency, _parse_date(days[0]), _parse_date(days[-1]))
+        except Exception:
+            return
+        resolved = [(day, rate) for day, rate in zip(days, lookup_rates(table, currency, days)) if rate is not None]
+        for day, rate in resolved:
+            base_rates[(currency, day)] = rate
+        await rates_cache.put_many(BASE_CURRENCY, currency, resolved, hot=track)
+
+    await asyncio.gather(*(resolve_currency(currency, days) for currency, days in missing.items()))
+
+    return base_rates
+
+
+async def get_exchange_rates(queries, track=True):
+    # queries: [(currency_from, currency_to, date_str)], результат - курсы в том же порядке,
+    # None для неподдерживаемых валют и дат без данных.
+    # track=False - запрос не учитывается в счетчиках попаданий кэша (фоновый прогрев)
+    queries = list(queries)
+    rates = [None] * len(queries)
+    needed = []
+    days_by_currency = defaultdict(set)
+
+    for i, (currency_from, currency_to, date_str) in enumerate(queries):
+        if (currency_from not in CURRENCY_EXCHANGE_OPTIONS) or (currency_to not in CURRENCY_EXCHANGE_OPTIONS):
+            continue
+        if currency_from == currency_to:
+            rates[i] = 1.0
+            continue
+
+        day = _parse_date(date_str).strftime("%Y-%m-%d")
+        days_by_currency[currency_from].add(day)
+        days_by_currency[currency_to].add(day)
+        needed.append((i, currency_from, currency_to, day))
+
+    base_rates = await _get_base_rates(days_by_currency, track=track)
+
+    # кросс-курс через базовую валюту, без дополнительных запросов
+    for i, currency_from, currency_to, day in needed:
+        rate_from = base_rates.get((currency_from, day))
+        rate_to = base_rates.get((currency_to, day))
+        if rate_from and rate_to:
+            rates[i] = rate_to / rate_from
+
+    return rates
+
+
+async def get_exchange_rate(currency_from: str, currency_to: str, amount: float, date_str):
+    if (currency_from not in CURRENCY_EXCHANGE_OPTIONS) or (currency_to not in CURRENCY_EXCHANGE_OPTIONS):
+        return None
+
+    _parse_date(date_str)
+
+    exchange_rate = (await get_exchange_rates([(currency_from, currency_to, date_str)]))[0]
+    if exchange_rate is None:
+        raise ValueError(f"No exchange rate for {currency_from} -> {currency_to} on {date_str[:10]}")
 
-    return exchange_rate * amount
\ No newline at end of file
+    return exchange_rate * amount
@@ -0,0 +1,164 @@
+import json
+import time
+import typing
+
+from aiogram.dispatcher.storage import BaseStorage
+
+# незавершенные диалоги (выбор участников траты, ввод суммы платежа) живут не дольше суток
+STATE_TTL = 24 * 60 * 60
+PURGE_INTERVAL = 10 * 60
+MAX_PAYLOAD_SIZE = 16 * 1024
+
+
+def create_fsm_storage(cursor):
+    # состояние, данные и bucket каждого (chat, user) - отдельная строка, поэтому запись
+    # затрагивает только ее, а не весь файл, как JSONStorage
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS fsm_states (" +
+        "chat_id INTEGER NOT NULL," +
+        "user_id INTEGER NOT NULL," +
+        "state TEXT," +
+        "data TEXT NOT NULL DEFAULT '{}'," +
+        "bucket TEXT NOT NULL DEFAULT '{}'," +
+        "updated_at REAL NOT NULL," +
+        "PRIMARY KEY (chat_id, user_id));"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS fsm_states_updated_at ON fsm_states (updated_at);")
+
+
+def _fetch_row(connection, chat_id, user_id, expired_before):
+    return connection.execute(
+        "SELECT state, data, bucket FROM fsm_states WHERE chat_id = ? AND user_id = ? AND updated_at >= ?",
+        (chat_id, user_id, expired_before)
+    ).fetchone()
+
+
+def _write_column(connection, column, chat_id, user_id, value, now, expired_before):
+    # просроченная строка не должна отдать старые значения соседних колонок
+    connection.execute(
+        "DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ? AND updated_at < ?",
+        (chat_id, user_id, expired_before)
+    )
+    connection.execute(f"""
+        INSERT INTO fsm_states (chat_id, user_id, {column}, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at
+        """, (chat_id, user_id, value, now))
+    # пустая строка ничего не хранит - удаляем, чтобы таблица не росла от завершенных диалогов
+    connection.execute(
+        "DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ? AND state IS NULL AND data = '{}' AND bucket = '{}'",
+        (chat_id, user_id)
+    )
+
+
+def _delete_expired(connection, expired_before):
+    return connection.execute("DELETE FROM fsm_states WHERE updated_at < ?", (expired_before,)).rowcount
+
+
+class SQLiteStorage(BaseStorage):
+    # хранилище FSM в таблице fsm_states основной базы, работает через пул соединений Database.
+    # Строки, не обновлявшиеся дольше ttl, считаются брошенными: они не читаются и удаляются
+    # при записи не чаще раза в purge_interval
+    def __init__(self, pool, ttl=STATE_TTL, purge_interval=PURGE_INTERVAL, max_payload_size=MAX_PAYLOAD_SIZE):
+        self.pool = pool
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.max_payload_size = max_payload_size
+        self.last_purge = 0.0
+
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def _address(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    def _dump(self, value):
+        payload = json.dumps(value, ensure_ascii=False)
+        if len(payload.encode()) > self.max_payload_size:
+            raise ValueError(f"FSM payload is {len(payload.encode())} bytes, limit is {self.max_payload_size}")
+        return payload
+
+    async def _read(self, chat, user):
+        # -> (state, data, bucket) или None, если строки нет или она просрочена
+        chat_id, user_id = self._address(chat, user)
+        return await self.pool.run(_fetch_row, chat_id, user_id, time.time() - self.ttl)
+
+    async def _write(self, column, chat, user, value):
+        chat_id, user_id = self._address(chat, user)
+        now = time.time()
+        async with self.pool.transaction():
+            await self.pool.run(_write_column, column, chat_id, user_id, value, now, now - self.ttl)
+            if now - self.last_purge >= self.purge_interval:
+                self.last_purge = now
+                await self.pool.run(_delete_expired, now - self.ttl)
+
+    async def _update(self, column, chat, user, data, kwargs):
+        # чтение и запись в одной транзакции, чтобы параллельные update_data не теряли ключи
+        async with self.pool.transaction():
+            row = await self._read(chat, user)
+            index = 1 if column == "data" else 2
+            value = json.loads(row[index]) if row else {}
+            value.update(data or {}, **kwargs)
+            await self._write(column, chat, user, self._dump(value))
+
+    async def purge_expired(self):
+        return await self.pool.run(_delete_expired, time.time() - self.ttl)
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        row = await self._read(chat, user)
+        if row is None or row[0] is None:
+            return self.resolve_state(default)
+        return row[0]
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        row = await self._read(chat, user)
+        return json.loads(row[1]) if row else dict(default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        await self._write("state", chat, user, self.resolve_state(state))
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        await self._write("data", chat, user, self._dump(data or {}))
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        await self._update("data", chat, user, data, kwargs)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        row = await self._read(chat, user)
+        return json.loads(row[2]) if row else dict(default or {})
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        await self._write("bucket", chat, user, self._dump(bucket or {}))
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        await self._update("bucket", chat, user, bucket, kwargs)
@@ -0,0 +1,98 @@
+import json
+
+# журнал только дописывается: траты и платежи хранятся в исходной валюте и с исходной датой,
+# а долги между парами пересчитываются из последнего снимка и хвоста журнала после него
+EXPENSE = 'expense'
+PAYMENT = 'payment'
+
+SNAPSHOT_INTERVAL = 1000
+SEED_CHUNK_SIZE = 1000
+
+
+def create_ledger(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS ledger (" +
+        "event_id INTEGER PRIMARY KEY," +
+        "chat_id INTEGER NOT NULL," +
+        "kind VARCHAR(16) NOT NULL," +
+        "creditor_id INTEGER NOT NULL," +
+        "debtor_id INTEGER NOT NULL," +
+        "amount REAL NOT NULL," +
+        "currency VARCHAR(8) NOT NULL," +
+        "description TEXT," +
+        "date DATE NOT NULL);"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS ledger_chat_event ON ledger (chat_id, event_id);")
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS ledger_snapshots (" +
+        "chat_id INTEGER NOT NULL," +
+        "event_id INTEGER NOT NULL," +
+        "state TEXT NOT NULL," +
+        "PRIMARY KEY (chat_id, event_id));"
+    )
+
+
+def seed_ledger(connection, chunk_size=SEED_CHUNK_SIZE):
+    # у существующих долгов нет истории - каждый становится начальной тратой с event_id = debt_id,
+    # поэтому прерванный засев продолжается с MAX(event_id)
+    while True:
+        connection.execute("BEGIN")
+        cursor = connection.execute("""
+            INSERT INTO ledger (event_id, chat_id, kind, creditor_id, debtor_id, amount, currency, description, date)
+            SELECT debt_id, chat_id, ?, creditor_id, debtor_id, amount, currency, description, date FROM debts
+            WHERE debt_id > (SELECT COALESCE(MAX(event_id), 0) FROM ledger)
+            ORDER BY debt_id LIMIT ?
+            """, (EXPENSE, chunk_size))
+        connection.commit()
+        if cursor.rowcount < chunk_size:
+            break
+
+
+def append_events(connection, events):
+    # events: [(chat_id, kind, creditor_id, debtor_id, amount_minor, currency, description, date)]
+    connection.executemany(
+        "INSERT INTO ledger (chat_id, kind, creditor_id, debtor_id, amount_minor, currency, description, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        events
+    )
+
+
+def apply_events(state, events):
+    # state: {(user_a, user_b, currency): сумма в минимальных единицах}, user_a < user_b, сумма > 0 - user_a должен user_b
+    for kind, creditor_id, debtor_id, amount, currency in events:
+        if kind == PAYMENT:
+            amount = -amount
+        if debtor_id < creditor_id:
+            key = (debtor_id, creditor_id, currency)
+        else:
+            key, amount = (creditor_id, debtor_id, currency), -amount
+        state[key] = state.get(key, 0) + amount
+    return state
+
+
+def replay(connection, chat_id, snapshot_interval=SNAPSHOT_INTERVAL):
+    # -> (state, event_id последнего учтенного события)
+    snapshot = connection.execute(
+        "SELECT event_id, state FROM ledger_snapshots WHERE chat_id = ? ORDER BY event_id DESC LIMIT 1",
+        (chat_id,)
+    ).fetchone()
+    version, state = 0, {}
+    if snapshot is not None:
+        version = snapshot[0]
+        state = {(a, b, currency): amount for a, b, currency, amount in json.loads(snapshot[1])}
+
+    events = connection.execute(
+        "SELECT event_id, kind, creditor_id, debtor_id, amount_minor, currency FROM ledger WHERE chat_id = ? AND event_id > ? ORDER BY event_id",
+        (chat_id, version)
+    ).fetchall()
+    if not events:
+        return state, version
+
+    apply_events(state, (event[1:] for event in events))
+    version = events[-1][0]
+
+    if len(events) >= snapshot_interval:
+        connection.execute(
+            "INSERT OR REPLACE INTO ledger_snapshots (chat_id, event_id, state) VALUES (?, ?, ?)",
+            (chat_id, version, json.dumps([[a, b, currency, amount] for (a, b, currency), amount in state.items()]))
+        )
+    return state, version
@@ -0,0 +1,102 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+
+# число знаков после запятой у минимальной единицы валюты (копейки, центы)
+CURRENCY_EXPONENTS = {
+    'USD': 2,
+    'EUR': 2,
+    'RUB': 2,
+}
+DEFAULT_EXPONENT = 2
+
+
+def currency_exponent(currency):
+    return CURRENCY_EXPONENTS.get(currency, DEFAULT_EXPONENT)
+
+
+class Money():
+    # сумма в целых минимальных единицах валюты: сложение и сравнение точные, без epsilon
+    __slots__ = ('minor', 'currency')
+
+    def __init__(self, minor: int, currency: str):
+        self.minor = int(minor)
+        self.currency = currency
+
+    @classmethod
+    def parse(cls, value, currency):
+        # value - строка или число в основных единицах ("12.5" -> 1250 центов)
+        try:
+            amount = Decimal(str(value)).scaleb(currency_exponent(currency)).quantize(Decimal(1), rounding=ROUND_HALF_EVEN)
+        except InvalidOperation:
+            raise ValueError(f"Invalid amount: {value!r}")
+        return cls(int(amount), currency)
+
+    @classmethod
+    def zero(cls, currency):
+        return cls(0, currency)
+
+    def to_decimal(self):
+        return Decimal(self.minor).scaleb(-currency_exponent(self.currency))
+
+    def convert(self, rate, currency):
+        # rate - сколько единиц currency за одну единицу self.currency
+        amount = self.to_decimal() * Decimal(rate)
+        return Money.parse(amount, currency)
+
+    def split(self, parts):
+        # делит без потерь: остаток в минимальных единицах достается первым долям
+        base, remainder = divmod(self.minor, parts)
+        return [Money(base + (i < remainder), self.currency) for i in range(parts)]
+
+    def _check(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        if other.currency != self.currency:
+            raise ValueError(f"Currency mismatch: {self.currency} and {other.currency}")
+        return other.minor
+
+    def __add__(self, other):
+        minor = self._check(other)
+        return NotImplemented if minor is NotImplemented else Money(self.minor + minor, self.currency)
+
+    def __sub__(self, other):
+        minor = self._check(other)
+        return NotImplemented if minor is NotImplemented else Money(self.minor - minor, self.currency)
+
+    def __neg__(self):
+        return Money(-self.minor, self.currency)
+
+    def __abs__(self):
+        return Money(abs(self.minor), self.currency)
+
+    def __bool__(self):
+        return self.minor != 0
+
+    def __eq__(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        return self.minor == other.minor and self.currency == other.currency
+
+    def __lt__(self, other):
+        minor = self._check(other)
+        return NotImplemented if minor is NotImplemented else self.minor < minor
+
+    def __le__(self, other):
+        minor = self._check(other)
+        return NotImplemented if minor is NotImplemented else self.minor <= minor
+
+    def __gt__(self, other):
+        minor = self._check(other)
+        return NotImplemented if minor is NotImplemented else self.minor > minor
+
+    def __ge__(self, other):
+        minor = self._check(other)
+        return NotImplemented if minor is NotImplemented else self.minor >= minor
+
+    def __hash__(self):
+        return hash((self.minor, self.currency))
+
+    def __str__(self):
+        return f"{self.to_decimal()} {self.currency}"
+
+    def __repr__(self):
+        return f"Money('{self.to_decimal()}', '{self.currency}')"
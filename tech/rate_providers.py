@@ -0,0 +1,67 @@
+import abc
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+import yfinance as yf
+
+# все курсы хранятся относительно базовой валюты: сколько единиц валюты дают за 1 BASE_CURRENCY,
+# любой кросс-курс from -> to считается как rates[to] / rates[from]
+BASE_CURRENCY = 'USD'
+
+
+class RateProvider(abc.ABC):
+    @abc.abstractmethod
+    def get_daily_rates(self, currencies, start: datetime, end: datetime) -> pd.DataFrame:
+        # индекс - дни (без таймзоны), колонки - валюты; строка за день d - курс, действующий в течение d
+        pass
+
+
+class YahooRateProvider(RateProvider):
+    def __init__(self, timeout=15):
+        self.timeout = timeout
+
+    def get_daily_rates(self, currencies, start, end):
+        table = {}
+        for currency in currencies:
+            if currency == BASE_CURRENCY:
+                continue
+            ticker = yf.Ticker(f"{BASE_CURRENCY+currency}=X")
+            hist = ticker.history(interval='1d', start=start - timedelta(days=10), end=end, timeout=self.timeout)['Close']
+            # закрытие дня d - последний известный курс на начало дня d + 1
+            index = hist.index.tz_localize(None) if hist.index.tz is not None else hist.index
+            hist.index = index.normalize() + timedelta(days=1)
+            table[currency] = hist
+
+        table = pd.DataFrame(table).sort_index()
+        table[BASE_CURRENCY] = 1.0
+        return table
+
+
+class FileRateProvider(RateProvider):
+    # CSV или Parquet с колонкой date и колонкой на каждую валюту
+    def __init__(self, path):
+        if os.path.splitext(path)[1] == '.parquet':
+            table = pd.read_parquet(path)
+        else:
+            table = pd.read_csv(path)
+
+        table['date'] = pd.to_datetime(table['date']).dt.normalize()
+        table = table.set_index('date').sort_index().astype(float)
+        table[BASE_CURRENCY] = 1.0
+        self.table = table
+
+    def get_daily_rates(self, currencies, start, end):
+        columns = [currency for currency in currencies if currency in self.table.columns]
+        # строки до start тоже нужны для поиска последнего известного курса
+        return self.table.loc[:end, columns]
+
+
+def lookup_rates(table, currency, days):
+    # для каждого дня берем последний известный курс на этот день (as-of)
+    if currency not in table.columns:
+        return [None] * len(days)
+    column = table[currency].dropna()
+    positions = column.index.searchsorted(pd.DatetimeIndex(days), side='right') - 1
+    values = column.to_numpy()
+    return [float(values[pos]) if pos >= 0 else None for pos in positions]
@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+import logging
+import sqlite3
+import time
+from collections import OrderedDict, defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+def create_exchange_rates(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS exchange_rates (" +
+        "currency_from VARCHAR(8) NOT NULL," +
+        "currency_to VARCHAR(8) NOT NULL," +
+        "day DATE NOT NULL," +
+        "rate REAL NOT NULL," +
+        "fetched_at REAL NOT NULL," +
+        "PRIMARY KEY (currency_from, currency_to, day));"
+    )
+
+
+def _select_rates(connection, keys):
+    # keys: [(currency_from, currency_to, day)] -> {key: (rate, fetched_at)}, один запрос на пару валют
+    days_by_pair = defaultdict(list)
+    for currency_from, currency_to, day in keys:
+        days_by_pair[(currency_from, currency_to)].append(day)
+
+    found = {}
+    for (currency_from, currency_to), days in days_by_pair.items():
+        placeholders = ", ".join("?" * len(days))
+        for day, rate, fetched_at in connection.execute(
+            "SELECT day, rate, fetched_at FROM exchange_rates " +
+            f"WHERE currency_from = ? AND currency_to = ? AND day IN ({placeholders})",
+            (currency_from, currency_to, *days)
+        ):
+            found[(currency_from, currency_to, day)] = (rate, fetched_at)
+    return found
+
+
+def _insert_rates(connection, rows):
+    connection.executemany(
+        "INSERT OR REPLACE INTO exchange_rates (currency_from, currency_to, day, rate, fetched_at) VALUES (?, ?, ?, ?, ?)",
+        rows
+    )
+
+
+class RatesCache():
+    # память (LRU) поверх таблицы exchange_rates. Запросы к базе идут через пул соединений Database,
+    # а не с потока event loop; пока пул не подключен (bind), кэш живет только в памяти.
+    # База для кэша не обязательна: ошибка чтения - промах, ошибка записи только пишется в лог
+    def __init__(self, pool=None, max_size=4096, today_ttl=15 * 60):
+        self.pool = pool
+        self.max_size = max_size
+        self.today_ttl = today_ttl
+
+        # (currency_from, currency_to, day) -> (rate, fetched_at)
+        self.memory = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = set()
+        # пока база занята, ждет не больше одного соединения пула
+        self.write_lock = asyncio.Lock()
+
+    def bind(self, pool):
+        self.pool = pool
+
+    def _remember(self, key, entry, hot=True):
+        if hot:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+        elif key in self.memory or len(self.memory) < self.max_size:
+            # фоновый прогрев не вытесняет то, что реально запрашивают: новые записи
+            # встают в холодный конец и попадают в память, только пока есть место
+            self.memory[key] = entry
+            self.memory.move_to_end(key, last=False)
+
+    def _is_fresh(self, day, fetched_at):
+        # курс, полученный после конца своего дня, уже не поменяется. Полученный в течение дня
+        # мог быть промежуточным и живет today_ttl секунд, даже когда день уже прошел
+        day_end = datetime.datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc) + datetime.timedelta(days=1)
+        if fetched_at >= day_end.timestamp():
+            return True
+        return time.time() - fetched_at < self.today_ttl
+
+    async def get_many(self, keys, track=True):
+        # keys: [(currency_from, currency_to, day)] -> {key: rate} только для свежих курсов.
+        # track=False - фоновый запрос: не учитывается в счетчиках и не двигает записи в LRU
+        entries = {}
+        missing = []
+        for key in keys:
+            entry = self.memory.get(key)
+            if entry is None:
+                missing.append(key)
+                continue
+            if track:
+                self.memory.move_to_end(key)
+            entries[key] = entry
+
+        if missing and self.pool is not None:
+            try:
+                found = await self.pool.run(_select_rates, missing)
+            except sqlite3.Error:
+                logger.warning("Exchange rates cache read failed", exc_info=True)
+                found = {}
+            for key, entry in found.items():
+                self._remember(key, entry, hot=track)
+            entries.update(found)
+
+        rates = {}
+        for key in keys:
+            entry = entries.get(key)
+            fresh = entry is not None and self._is_fresh(key[2], entry[1])
+            if track:
+                if fresh:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if fresh:
+                rates[key] = entry[0]
+        return rates
+
+    async def get(self, currency_from, currency_to, day, track=True):
+        key = (currency_from, currency_to, day)
+        return (await self.get_many([key], track=track)).get(key)
+
+    async def put(self, currency_from, currency_to, day, rate):
+        await self.put_many(currency_from, currency_to, [(day, rate)])
+
+    async def put_many(self, currency_from, currency_to, day_rates, hot=True):
+        fetched_at = time.time()
+        rows = [(currency_from, currency_to, day, rate, fetched_at) for day, rate in day_rates]
+        if not rows:
+            return
+        for row in rows:
+            self._remember(row[:3], row[3:], hot=hot)
+
+        if self.pool is None:
+            return
+        # запись в базу в фоне: курс уже в памяти, а занятая чужой транзакцией база
+        # не должна задерживать ответ пользователю
+        write = asyncio.create_task(self._write(rows))
+        self.writes.add(write)
+        write.add_done_callback(self.writes.discard)
+
+    async def _write(self, rows):
+        try:
+            async with self.write_lock:
+                await self.pool.run_detached(_insert_rates, rows)
+        except sqlite3.Error:
+            # в базу курс попадет при следующей загрузке
+            logger.warning("Exchange rates cache write failed", exc_info=True)
+
+    async def flush(self):
+        # дождаться фоновых записей, например перед закрытием базы
+        if self.writes:
+            await asyncio.gather(*self.writes)
@@ -0,0 +1,54 @@
+import asyncio
+import datetime
+import logging
+
+from .exchange_rates_api import CURRENCY_EXCHANGE_OPTIONS, get_exchange_rates, rates_cache
+
+logger = logging.getLogger(__name__)
+
+
+class RatesPrefetcher():
+    def __init__(self, db, interval=10 * 60):
+        self.db = db
+        self.interval = interval
+        self.task = None
+
+    async def _queries(self):
+        today = str(datetime.datetime.now(tz=datetime.timezone.utc))
+        queries = [
+            (currency_from, currency_to, today)
+            for currency_from in CURRENCY_EXCHANGE_OPTIONS
+            for currency_to in CURRENCY_EXCHANGE_OPTIONS
+            if currency_from != currency_to
+        ]
+        # курсы на даты существующих долгов - их запросит конвертация в /debts и /pay_debt
+        for currency, day in await self.db.get_debt_currency_days():
+            queries += [(currency, currency_to, day) for currency_to in CURRENCY_EXCHANGE_OPTIONS if currency_to != currency]
+        return queries
+
+    async def refresh(self):
+        await get_exchange_rates(await self._queries(), track=False)
+        logger.info("Exchange rates cache: %d hits, %d misses", rates_cache.hits, rates_cache.misses)
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Exchange rates prefetch failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        # фоновые записи кэша курсов должны закончиться до закрытия базы
+        await rates_cache.flush()
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+
+from aiogram.utils import markdown as md
+
+from . import texts
+from .money import Money
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+MAX_CONCURRENT_CHATS = 10
+# верхняя граница сна: на случай, если напоминание добавил другой процесс
+MAX_SLEEP = 60
+
+
+class ReminderScheduler():
+    # спит до ближайшего next_due (MIN по индексу), забирает наступившие напоминания пачками
+    # по batch_size и рассылает их не больше чем по max_concurrent_chats чатов одновременно;
+    # сами сообщения идут через SendScheduler с его лимитами
+    def __init__(self, db, send_scheduler, batch_size=BATCH_SIZE, max_concurrent_chats=MAX_CONCURRENT_CHATS):
+        self.db = db
+        self.send_scheduler = send_scheduler
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(max_concurrent_chats)
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.sent = 0
+
+    def notify(self):
+        # политика чата изменилась - пересчитать время сна
+        self.wakeup.set()
+
+    async def remind_chat(self, chat_id):
+        debts = await self.db.get_debts_from_chat(chat_id)
+        if not debts:
+            return
+        lang = await self.db.get_chat_lang(chat_id)
+        usernames = await self.db.get_usernames(chat_id, [user_id for debt in debts for user_id in debt[1:3]])
+
+        # (debtor_id, creditor_id) -> текст; несколько сообщений одному должнику склеит SendScheduler
+        reminders = {}
+        for debt in debts:
+            key = (debt[1], debt[2])
+            if key not in reminders:
+                reminders[key] = texts.PING_START.render(lang, usernames.get(debt[2]))
+            reminders[key] += md.escape_md(f"{Money(debt[3], debt[4])}\n")
+
+        results = await asyncio.gather(
+            *(self.send_scheduler.enqueue(debtor_id, text) for (debtor_id, _), text in reminders.items()),
+            return_exceptions=True
+        )
+        self.sent += sum(not isinstance(result, Exception) for result in results)
+
+    async def _remind_chat(self, chat_id):
+        async with self.semaphore:
+            try:
+                await self.remind_chat(chat_id)
+            except Exception:
+                logger.exception("Reminder for chat %s failed", chat_id)
+
+    async def tick(self):
+        # -> сколько чатов обработано
+        processed = 0
+        while True:
+            chat_ids = await self.db.claim_due_reminders(time.time(), self.batch_size)
+            if not chat_ids:
+                return processed
+            await asyncio.gather(*(self._remind_chat(chat_id) for chat_id in chat_ids))
+            processed += len(chat_ids)
+
+    async def run(self):
+        while True:
+            try:
+                await self.tick()
+                due = await self.db.get_next_reminder_due()
+            except Exception:
+                logger.exception("Reminder tick failed")
+                due = None
+            sleep = MAX_SLEEP if due is None else min(max(due - time.time(), 0), MAX_SLEEP)
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), sleep)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
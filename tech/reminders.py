@@ -0,0 +1,41 @@
+import time
+
+# политика напоминаний - одна строка на чат; планировщик берет только строки с next_due <= now
+# по индексу, поэтому цена тика зависит от числа наступивших напоминаний, а не от числа чатов
+
+
+def create_reminders(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS reminders (" +
+        "chat_id INTEGER PRIMARY KEY," +
+        "interval_seconds INTEGER NOT NULL," +
+        "next_due REAL NOT NULL);"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS reminders_next_due ON reminders (next_due);")
+
+
+def set_reminder(connection, chat_id, interval_seconds):
+    connection.execute("""
+        INSERT INTO reminders (chat_id, interval_seconds, next_due) VALUES (?, ?, ?)
+        ON CONFLICT (chat_id) DO UPDATE SET interval_seconds = excluded.interval_seconds, next_due = excluded.next_due
+        """, (chat_id, interval_seconds, time.time() + interval_seconds))
+
+
+def claim_due(connection, now, limit):
+    # -> [chat_id]; срок сдвигается сразу, в той же транзакции, поэтому напоминание
+    # уходит не больше одного раза, даже если планировщиков несколько
+    chat_ids = [row[0] for row in connection.execute(
+        "SELECT chat_id FROM reminders WHERE next_due <= ? ORDER BY next_due LIMIT ?",
+        (now, limit)
+    )]
+    if chat_ids:
+        placeholders = ", ".join("?" * len(chat_ids))
+        connection.execute(
+            f"UPDATE reminders SET next_due = ? + interval_seconds WHERE chat_id IN ({placeholders})",
+            (now, *chat_ids)
+        )
+    return chat_ids
+
+
+def next_due(connection):
+    return connection.execute("SELECT MIN(next_due) FROM reminders").fetchone()[0]
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from aiogram.utils.exceptions import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# лимиты Bot API: ~30 сообщений в секунду на бота, 1 в секунду в личный чат, 20 в минуту в группу
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+MAX_IN_FLIGHT = 8
+MESSAGE_LIMIT = 4096
+BUCKETS_PRUNE_SIZE = 1024
+
+
+class TokenBucket():
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        # сколько секунд ждать до следующего токена
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Outgoing():
+    __slots__ = ('text', 'kwargs', 'futures')
+
+    def __init__(self, text, kwargs):
+        self.text = text
+        self.kwargs = kwargs
+        self.futures = []
+
+
+class SendScheduler():
+    # очередь исходящих сообщений: отправка через общий token bucket и bucket на каждый чат,
+    # в чат одновременно идет не больше одного сообщения (порядок сохраняется), несколько
+    # ожидающих сообщений одному получателю склеиваются в одно. На RetryAfter вся отправка
+    # замирает на указанное Telegram время, а сообщение возвращается в начало очереди чата
+    def __init__(self, bot, global_rate=GLOBAL_RATE, private_rate=PRIVATE_CHAT_RATE, group_rate=GROUP_CHAT_RATE,
+                 max_in_flight=MAX_IN_FLIGHT, shards=1):
+        self.bot = bot
+        # лимит на бота общий для всех процессов: при шардировании каждый шард получает свою долю.
+        # Bucket'ы чатов свои в каждом процессе: группу обслуживает один шард, но личные сообщения
+        # одному пользователю могут идти из нескольких шардов, и тогда лимит чата превышается до
+        # shards раз - от этого остается только пауза по RetryAfter
+        global_rate = global_rate / shards
+        self.global_bucket = TokenBucket(global_rate, capacity=max(global_rate, 1))
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.max_in_flight = max_in_flight
+        # {chat_id: deque[_Outgoing]} в порядке очереди чатов (round-robin)
+        self.pending = OrderedDict()
+        self.chat_buckets = {}
+        self.busy = set()
+        self.paused_until = 0.0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.deliveries = set()
+
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+
+    def enqueue(self, chat_id, text, **kwargs):
+        # -> future с отправленным сообщением (общим для склеенных) или исключением отправки
+        future = asyncio.get_running_loop().create_future()
+        queue = self.pending.setdefault(chat_id, deque())
+        last = queue[-1] if queue else None
+        if last is not None and last.kwargs == kwargs and len(last.text) + 2 + len(text) <= MESSAGE_LIMIT:
+            last.text += "\n\n" + text
+            self.coalesced += 1
+        else:
+            last = _Outgoing(text, kwargs)
+            queue.append(last)
+        last.futures.append(future)
+        self.wakeup.set()
+        return future
+
+    async def send(self, chat_id, text, **kwargs):
+        return await self.enqueue(chat_id, text, **kwargs)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= BUCKETS_PRUNE_SIZE:
+                now = time.monotonic()
+                for idle in [c for c, b in self.chat_buckets.items() if c not in self.pending and b.is_full(now)]:
+                    del self.chat_buckets[idle]
+            # у групп и каналов chat_id отрицательный
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.private_rate if chat_id > 0 else self.group_rate)
+        return bucket
+
+    def _next_ready(self, now):
+        # -> (chat_id или None, через сколько секунд проверить снова)
+        wait = None
+        for chat_id in self.pending:
+            if chat_id in self.busy:
+                continue
+            delay = self._chat_bucket(chat_id).delay(now)
+            if delay == 0:
+                return chat_id, 0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _wait(self, timeout):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if len(self.busy) >= self.max_in_flight:
+                await self._wait(None)
+                continue
+
+            chat_id, wait = self._next_ready(now)
+            if chat_id is None:
+                await self._wait(wait)
+                continue
+            delay = self.global_bucket.delay(now)
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+
+            self.global_bucket.take(now)
+            self._chat_bucket(chat_id).take(now)
+            message = self.pending[chat_id].popleft()
+            self.pending.move_to_end(chat_id)
+            self.busy.add(chat_id)
+            delivery = asyncio.create_task(self._deliver(chat_id, message))
+            self.deliveries.add(delivery)
+            delivery.add_done_callback(self.deliveries.discard)
+
+    async def _deliver(self, chat_id, message):
+        try:
+            result = await self.bot.send_message(chat_id, message.text, **message.kwargs)
+        except RetryAfter as e:
+            self.retries += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + e.timeout)
+            self.pending.setdefault(chat_id, deque()).appendleft(message)
+            logger.warning("Flood control on chat %s, pausing sends for %s s", chat_id, e.timeout)
+        except Exception as e:
+            self.failed += 1
+            for future in message.futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            self.sent += 1
+            for future in message.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.busy.discard(chat_id)
+            if not self.pending.get(chat_id, True):
+                del self.pending[chat_id]
+            self.wakeup.set()
+
+    def queue_depth(self, chat_id=None):
+        if chat_id is not None:
+            return len(self.pending.get(chat_id, ()))
+        return sum(len(queue) for queue in self.pending.values())
+
+    def stats(self):
+        return {
+            'queued': self.queue_depth(),
+            'chats': len(self.pending),
+            'in_flight': len(self.busy),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'retries': self.retries,
+            'failed': self.failed,
+        }
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for delivery in list(self.deliveries):
+            delivery.cancel()
+        for queue in self.pending.values():
+            for message in queue:
+                for future in message.futures:
+                    future.cancel()
+        self.pending.clear()
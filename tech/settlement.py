@@ -0,0 +1,91 @@
+import heapq
+from collections import defaultdict
+
+# точное решение перебирает подмножества участников, поэтому только для небольших групп
+EXACT_MAX_MEMBERS = 15
+
+
+def sum_balances(entries):
+    # entries: [(user_id, сумма в минимальных единицах)] в одной валюте -> {user_id: баланс} без нулевых
+    balances = defaultdict(int)
+    for user_id, amount in entries:
+        balances[user_id] += amount
+    return {user_id: balance for user_id, balance in balances.items() if balance != 0}
+
+
+def net_balances(debts):
+    # debts: [(debtor_id, creditor_id, amount)] в одной валюте -> {user_id: баланс},
+    # положительный баланс - пользователю должны, отрицательный - он должен
+    entries = []
+    for debtor_id, creditor_id, amount in debts:
+        entries += [(creditor_id, amount), (debtor_id, -amount)]
+    return sum_balances(entries)
+
+
+def settle_greedy(balances):
+    # самый большой должник платит самому большому кредитору: не больше n - 1 переводов, O(n log n)
+    creditors = [(-balance, user_id) for user_id, balance in balances.items() if balance > 0]
+    debtors = [(balance, user_id) for user_id, balance in balances.items() if balance < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor_id = heapq.heappop(creditors)
+        debt, debtor_id = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append((debtor_id, creditor_id, amount))
+
+        credit += amount
+        debt += amount
+        if credit < 0:
+            heapq.heappush(creditors, (credit, creditor_id))
+        if debt < 0:
+            heapq.heappush(debtors, (debt, debtor_id))
+    return transfers
+
+
+def settle_exact(balances):
+    # минимум переводов = n - (максимальное число непересекающихся групп с нулевой суммой).
+    # Ищем порядок участников с наибольшим числом нулевых префиксных сумм (динамика по
+    # подмножествам, O(2^n * n)), режем его на группы по этим префиксам и гасим каждую жадно
+    members = [user_id for user_id, balance in balances.items() if balance != 0]
+    count = len(members)
+    if count > EXACT_MAX_MEMBERS:
+        raise ValueError(f"Exact settlement supports at most {EXACT_MAX_MEMBERS} members, got {count}")
+
+    amounts = [balances[user_id] for user_id in members]
+    full = (1 << count) - 1
+
+    subset_sum = [0] * (full + 1)
+    zero_groups = [0] * (full + 1)
+    last_member = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        lowest = mask & -mask
+        subset_sum[mask] = subset_sum[mask ^ lowest] + amounts[lowest.bit_length() - 1]
+
+        best = -1
+        for i in range(count):
+            if mask >> i & 1 and zero_groups[mask ^ (1 << i)] > best:
+                best, last_member[mask] = zero_groups[mask ^ (1 << i)], i
+        zero_groups[mask] = best + (subset_sum[mask] == 0)
+
+    transfers = []
+    group = {}
+    mask = full
+    while mask:
+        if subset_sum[mask] == 0 and group:
+            transfers += settle_greedy(group)
+            group = {}
+        i = last_member[mask]
+        group[members[i]] = balances[members[i]]
+        mask ^= 1 << i
+    transfers += settle_greedy(group)
+    return transfers
+
+
+def settle(balances, exact=None):
+    # exact=None - точный режим автоматически для небольших групп
+    if exact is None:
+        exact = len(balances) <= EXACT_MAX_MEMBERS
+    return settle_exact(balances) if exact else settle_greedy(balances)
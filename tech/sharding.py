@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# объекты обновления, в которых есть чат; для остальных (inline-запросы и т.п.) шард выбирается по from
+CHAT_OBJECTS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'my_chat_member', 'chat_member', 'chat_join_request',
+)
+USER_OBJECTS = (
+    'inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query', 'poll_answer',
+)
+FORWARD_TIMEOUT = 60
+
+
+def update_chat_id(update):
+    # update - JSON обновления Telegram -> chat_id, по которому обновление привязывается к шарду
+    for key in CHAT_OBJECTS:
+        if key in update:
+            return update[key]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query is not None:
+        if 'message' in callback_query:
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for key in USER_OBJECTS:
+        if key in update:
+            user = update[key].get('from') or update[key].get('user')
+            return user['id'] if user else None
+    return None
+
+
+def shard_for(chat_id, shards):
+    # остаток от деления сохраняет привязку чата к шарду между перезапусками (в отличие от hash() строк)
+    return 0 if chat_id is None else chat_id % shards
+
+
+class ShardRouter():
+    # принимает вебхук Telegram и пересылает обновление в процесс-шард своего чата. Обновления
+    # одного чата пересылаются строго по очереди (следующее - после ответа шарда на предыдущее),
+    # разные чаты идут параллельно
+    def __init__(self, shard_urls, timeout=FORWARD_TIMEOUT):
+        self.shard_urls = shard_urls
+        self.timeout = timeout
+        self.session = None
+        # {chat_id: [lock, число ожидающих]} - запись удаляется, когда у чата не остается обновлений
+        self.chat_locks = {}
+
+    async def open(self, app=None):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self, app=None):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _forward(self, shard, body):
+        async with self.session.post(self.shard_urls[shard], data=body, headers={'Content-Type': 'application/json'}) as response:
+            return web.Response(body=await response.read(), status=response.status, content_type=response.content_type)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        try:
+            chat_id = update_chat_id(await request.json())
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        shard = shard_for(chat_id, len(self.shard_urls))
+
+        entry = self.chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self._forward(shard, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # не 2xx - Telegram повторит доставку позже
+            logger.exception("Failed to forward update for chat %s to shard %d", chat_id, shard)
+            return web.Response(status=502)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chat_locks[chat_id]
+
+    def setup(self, app, path):
+        app.router.add_post(path, self.handle)
+        app.on_startup.append(self.open)
+        app.on_cleanup.append(self.close)
@@ -0,0 +1,86 @@
+import string
+
+from aiogram.utils.text_decorations import markdown_decoration
+
+# язык, на который падает текст без перевода: новый язык можно добавлять не во все тексты сразу
+FALLBACK_LANG = 'en'
+
+# таблица для str.translate из того же набора символов, что экранирует md.escape_md:
+# re.sub разбирает шаблон замены на каждом вызове, translate заметно быстрее на коротких значениях
+_ESCAPE = {
+    code: '\\' + chr(code)
+    for code in range(128)
+    if markdown_decoration.MARKDOWN_QUOTE_PATTERN.fullmatch(chr(code))
+}
+
+
+def escape(value):
+    return str(value).translate(_ESCAPE)
+
+
+class Template():
+    # format-строка, разобранная один раз: статические куски уже экранированы для MarkdownV2,
+    # при render экранируются только подставляемые значения. Экранирование в MarkdownV2
+    # посимвольное, поэтому результат тот же, что у md.escape_md(text.format(...))
+    __slots__ = ('parts', 'static')
+
+    def __init__(self, text):
+        parts = []
+        index = 0
+        # как и str.format, не смешиваем автоматическую ({}) и ручную ({0}) нумерацию полей
+        numbering = None
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if literal:
+                parts.append(escape(literal))
+            if field is None:
+                continue
+            if field == '' or field.isdigit():
+                mode = 'auto' if field == '' else 'manual'
+                if numbering not in (None, mode):
+                    raise ValueError(f"cannot mix automatic and manual field numbering: {text!r}")
+                numbering = mode
+            if field == '':
+                field, index = index, index + 1
+            elif field.isdigit():
+                field = int(field)
+            parts.append((field, spec, conversion))
+        self.parts = parts
+        self.static = ''.join(parts) if all(isinstance(part, str) for part in parts) else None
+
+    def render(self, *args, **kwargs):
+        if self.static is not None:
+            return self.static
+        rendered = []
+        for part in self.parts:
+            if isinstance(part, str):
+                rendered.append(part)
+                continue
+            field, spec, conversion = part
+            value = args[field] if isinstance(field, int) else kwargs[field]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 's':
+                value = str(value)
+            rendered.append(escape(format(value, spec)))
+        return ''.join(rendered)
+
+
+class Text(dict):
+    # {lang: исходная строка} - как и раньше, для кнопок и прочих мест без разметки,
+    # плюс скомпилированные шаблоны для сообщений в MarkdownV2
+    __slots__ = ('templates',)
+
+    def __init__(self, translations):
+        super().__init__(translations)
+        self.templates = {lang: Template(text) for lang, text in translations.items()}
+
+    def render(self, lang, *args, **kwargs):
+        template = self.templates.get(lang) or self.templates[FALLBACK_LANG]
+        return template.render(*args, **kwargs)
+
+
+def compile_texts(namespace):
+    # заменяет все словари переводов модуля на Text
+    for name, value in list(namespace.items()):
+        if name.isupper() and isinstance(value, dict) and all(isinstance(text, str) for text in value.values()):
+            namespace[name] = Text(value)
@@ -1,3 +1,6 @@
+from .templates import compile_texts as _compile_texts
+
+
 HELLO = {
     "en": "Hello, ",
     "ru": "Привет, "
@@ -13,11 +16,15 @@ HELP_TEXT = {
         "/lang - Enter this command to change the language.\n" \
         "/register phone preferred_bank - Register in the chat and specify your phone number for transfers and your preferred bank.\n" \
         "/ping @username - The bot will send a private message to this person indicating their debt to you. For this, the person must have sent the command /start in a private chat with the bot.\n" \
+        "/ping_all - Send such a message to everyone who owes you in this chat.\n" \
+        "/remind days - Remind all debtors in the chat about their debts every given number of days. /remind off turns reminders off.\n" \
         "/expense amount currency description - Add an expense. The bot will then offer to select participants from the list of registered users and you must click the \"Split equally\" button. To specify different proportions, select people one by one.\n" \
         "/debts - Show a list of all debts in the chat. By clicking on \"Convert to one currency\" the bot will convert all debts to one currency, at the rate on the date of entry.\n" \
         "/debts_to_me - Show a list of all debts owed to you personally.\n" \
         "/my_debts - Show a list of all your debts.\n" \
-        "/pay_debt @username - Pay off your debt to username. The bot will first write how much you owe them and will offer to pay. Respond to the bot's message with the paid amount and currency.",
+        "/pay_debt @username - Pay off your debt to username. The bot will first write how much you owe them and will offer to pay. Respond to the bot's message with the paid amount and currency.\n" \
+        "/settle currency - Show the minimal set of transfers that settles all debts in the chat, at today's rate.\n" \
+        "/ledger - Show debts between every pair, recomputed from the history of expenses and payments in their original currencies, without conversion.",
 
     "ru": "Для того, чтобы начать мной пользоваться - просто добавь меня в чат!\n" \
         "Сейчас я подробно опишу каждую команду:\n\n" \
@@ -25,11 +32,15 @@ HELP_TEXT = {
         "/lang - Введите эту команду чтоб поменять язык.\n" \
         "/register phone preffered_bank - Так вы зарегистрируетесь в чате и укажете свой номер телефона для переводов и желаемый банк.\n" \
         "/ping @username - Бот отправит этому человеку личное сообщение с указанием его долга вам. Для этого человек должен в личных сообщениях с ботом отправить команду /start\n" \
+        "/ping_all - Отправить такое сообщение всем, кто должен вам в этом чате\n" \
+        "/remind days - Напоминать всем должникам чата об их долгах раз в указанное число дней. /remind off выключает напоминания\n" \
         "/expense amount currency description - Добавить трату. В ответ бот предложит выбрать участников из списка зарегистрированных и надо нажать кнопку \"Разделить поровну\".\n Чтоб указать разнве пропорции - выбирайте людей по одному.\n" \
         "/debts - Показать список всех долгов в чате. По кнопке \"Привести к одной валюте\" бот сконвертирует все долги к одной валюте, по курсу на момент даты добавления.\n" \
         "/debts_to_me - Показать список всех долгов лично вам.\n" \
         "/my_debts - Показать список всех ваших долгов.\n" \
-        "/pay_debt @username - Погасить ваш долг username. Сначала бот напишет, сколько вы ему должны и предложит оплатить. Ответьте на сообщение бота оплаченной суммой и валютой."
+        "/pay_debt @username - Погасить ваш долг username. Сначала бот напишет, сколько вы ему должны и предложит оплатить. Ответьте на сообщение бота оплаченной суммой и валютой.\n" \
+        "/settle currency - Показать минимальный набор переводов, который закрывает все долги в чате, по сегодняшнему курсу.\n" \
+        "/ledger - Показать долги каждой пары, пересчитанные по истории трат и платежей в исходных валютах, без конвертации."
 }
 REGISTER_TEXT_WRONG_FORMAT = {
     "en": "Please send the command in the format /register phone preferred_bank",
@@ -47,9 +58,9 @@ PING_START = {
     "en": "You owe {}:\n",
     "ru": "Ты должен {}:\n"
 }
-SUCCESSFULL_MESSAGE = {
-    "en": "Message sent successfully!",
-    "ru": "Сообщение успешно отправлено!"
+MESSAGE_QUEUED = {
+    "en": "Message queued for delivery!",
+    "ru": "Сообщение поставлено в очередь на отправку!"
 }
 CANNOT_SEND_MESSAGE = {
     "en": "Failed to send a message to user @{}",
@@ -59,6 +70,30 @@ USER_NOT_FOUND = {
     "en": "User not found.",
     "ru": "Пользователь не найден."
 }
+PING_ALL_QUEUED = {
+    "en": "Reminders queued: {}",
+    "ru": "Напоминания поставлены в очередь: {}"
+}
+PING_ALL_SENT = {
+    "en": "Reminders sent: {} of {}. Could not reach: {}",
+    "ru": "Напоминания отправлены: {} из {}. Не удалось написать: {}"
+}
+REMIND_WRONG_FORMAT = {
+    "en": "Use the command in the format: /remind days or /remind off",
+    "ru": "Используйте команду в формате: /remind days или /remind off"
+}
+REMIND_SET = {
+    "en": "I will remind debtors about their debts every {} day(s).",
+    "ru": "Буду напоминать должникам об их долгах раз в {} дн."
+}
+REMIND_OFF = {
+    "en": "Reminders are turned off.",
+    "ru": "Напоминания выключены."
+}
+REMIND_NOT_SET = {
+    "en": "Reminders are not set up in this chat. Turn them on with /remind days",
+    "ru": "Напоминания в этом чате не настроены. Включить: /remind days"
+}
 PING_WRONG_FORMAT = {
     "en": "Please specify the user in the message, for example: /ping @username",
     "ru": "Пожалуйста, укажите пользователя в сообщении, например: /ping @username"
@@ -124,17 +159,29 @@ YOU_OWE = {
     "ru": "{} должен:\n"
 }
 YOU_OWE_USER = {
-    "en": "To user {creditor} you owe",
+    "en": "To user {} you owe",
     "ru": "Пользователю {} ты должен"
 }
 CURRENCY_TO_CAST = {
     "en": "Select a currency to convert all debts:",
     "ru": "Выберите валюту для приведения всех долгов:"
 }
+NEXT_PAGE = {
+    "en": "Next ▶",
+    "ru": "Далее ▶"
+}
+PREV_PAGE = {
+    "en": "◀ Back",
+    "ru": "◀ Назад"
+}
 NO_DEBTS_SELECTED = {
     "en": "No debts to convert.",
     "ru": "Долгов для приведения нет."
 }
+DEBTS_CHANGED = {
+    "en": "Debts have changed since the list was shown, converting the current ones.",
+    "ru": "Долги изменились с момента показа списка, привожу актуальные."
+}
 CURRENCY_CONVERTION_ERROR = {
     "en": "Currency convertion error.",
     "ru": "Ошибка конвертации валют."
@@ -190,4 +237,20 @@ LANGUAGE_SET_TO = {
 LANGUAGE_UPDATED = {
     "en": "Language updated!",
     "ru": "Язык обновлен!"
-}
\ No newline at end of file
+}
+SETTLE_WRONG_FORMAT = {
+    "en": "Use the command in the format: /settle currency. Available currencies: {}",
+    "ru": "Используйте команду в формате: /settle currency. Доступные валюты: {}"
+}
+SETTLE_PLAN = {
+    "en": "To settle all debts in {}:\n",
+    "ru": "Чтобы закрыть все долги в {}:\n"
+}
+
+LEDGER_BALANCES = {
+    "en": "Debts from the history of expenses and payments, in original currencies:\n",
+    "ru": "Долги по истории трат и платежей, в исходных валютах:\n"
+}
+
+
+_compile_texts(globals())
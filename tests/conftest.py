@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+from tech import exchange_rates_api
+from tech.database import Database
+from tech.exchange_rates_api import set_rate_provider
+from tech.rate_providers import FileRateProvider
+
+RATES_CSV = """date,EUR,RUB
+2024-01-01,0.90,90
+2024-01-02,0.92,92
+2024-01-05,0.95,95
+"""
+
+
+@pytest.fixture
+def offline_rates(tmp_path, monkeypatch):
+    path = tmp_path / "rates.csv"
+    path.write_text(RATES_CSV)
+    provider = FileRateProvider(str(path))
+    # monkeypatch вернет прежний провайдер и пул кэша после теста
+    monkeypatch.setattr(exchange_rates_api, "rate_provider", exchange_rates_api.rate_provider)
+    monkeypatch.setattr(exchange_rates_api.rates_cache, "pool", None)
+    exchange_rates_api.rates_cache.memory.clear()
+    set_rate_provider(provider)
+    yield provider
+    exchange_rates_api.rates_cache.memory.clear()
+
+
+@pytest.fixture
+def run_with_db(tmp_path):
+    # run_with_db(scenario): scenario(db) выполняется в своем event loop на свежей мигрированной базе
+    def run(scenario):
+        db = Database(str(tmp_path / "test.db"))
+        db.start()
+        try:
+            return asyncio.run(scenario(db))
+        finally:
+            db.finish()
+    return run
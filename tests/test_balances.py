@@ -0,0 +1,67 @@
+import sqlite3
+
+from tech.database import Database
+from tech.money import Money
+
+CHAT = 100
+
+
+async def balances(db):
+    return {(user_id, currency): balance for user_id, currency, balance in await db.get_balances(CHAT)}
+
+
+def test_triggers_follow_debts(run_with_db):
+    async def scenario(db):
+        steps = []
+
+        async def step(name, expected):
+            steps.append((name, await balances(db), expected, await db.check_balances(CHAT)))
+
+        # insert
+        await db.apply_expense_split(1, {2: Money(500, "USD"), 3: Money(300, "USD")}, "USD", "x", CHAT)
+        await step("insert", {(1, "USD"): 800, (2, "USD"): -500, (3, "USD"): -300})
+
+        # update в ту же сторону
+        await db.apply_expense_split(1, {2: Money(100, "USD")}, "USD", "x", CHAT)
+        await step("update", {(1, "USD"): 900, (2, "USD"): -600, (3, "USD"): -300})
+
+        # update со сменой кредитора и должника: 3 должен 1 300, 1 тратит 500 за 3 -> 1 должен 3 200
+        await db.apply_expense_split(3, {1: Money(500, "USD")}, "USD", "x", CHAT)
+        await step("flip", {(1, "USD"): 400, (2, "USD"): -600, (3, "USD"): 200})
+
+        # delete: встречная трата гасит долг целиком
+        await db.apply_expense_split(2, {1: Money(600, "USD")}, "USD", "x", CHAT)
+        await step("delete", {(1, "USD"): -200, (3, "USD"): 200})
+
+        # прямые update_debt / delete_debt, как при оплате
+        debt_id = (await db.get_debts_from_chat(CHAT))[0][0]
+        await db.update_debt(debt_id, Money(50, "USD"))
+        await step("update_debt", {(1, "USD"): -50, (3, "USD"): 50})
+        await db.delete_debt(debt_id)
+        await step("delete_debt", {})
+        return steps
+
+    for name, actual, expected, mismatches in run_with_db(scenario):
+        assert actual == expected, name
+        assert mismatches == [], name
+
+
+def test_startup_repairs_drifted_balances(tmp_path):
+    path = str(tmp_path / "drift.db")
+    db = Database(path)
+    db.migrate()
+    connection = sqlite3.connect(path)
+    connection.execute("INSERT INTO chats (chat_id) VALUES (?)", (CHAT,))
+    connection.execute(
+        "INSERT INTO debts (creditor_id, debtor_id, amount_minor, currency, date, chat_id) VALUES (1, 2, 500, 'USD', '2024-01-01', ?)",
+        (CHAT,)
+    )
+    # рассинхрон, который триггеры сами не исправят
+    connection.execute("UPDATE balances SET balance_minor = 0 WHERE user_id = 1")
+    connection.execute("INSERT INTO balances (chat_id, user_id, currency, balance_minor) VALUES (?, 9, 'EUR', 70)", (CHAT,))
+    connection.commit()
+
+    Database(path).migrate()
+    assert set(connection.execute("SELECT user_id, currency, balance_minor FROM balances WHERE balance_minor != 0")) == {
+        (1, "USD", 500), (2, "USD", -500)
+    }
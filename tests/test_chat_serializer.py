@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from tech.chat_serializer import ChatSerializationMiddleware
+
+
+def make_update(update_id, chat_id, text):
+    return types.Update.to_object({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "group"},
+            "from": {"id": 1, "is_bot": False, "first_name": "x"},
+            "text": text,
+        },
+    })
+
+
+def run(scenario):
+    async def main():
+        dp = Dispatcher(Bot(token="123456:test"))
+        serializer = ChatSerializationMiddleware()
+        dp.middleware.setup(serializer)
+        try:
+            return await scenario(dp, serializer)
+        finally:
+            await (await dp.bot.get_session()).close()
+    return asyncio.run(main())
+
+
+def test_updates_of_one_chat_run_in_order():
+    events = []
+
+    async def scenario(dp, serializer):
+        @dp.message_handler()
+        async def handler(message):
+            events.append(("start", message.chat.id, message.text))
+            # первое обновление каждого чата обрабатывается дольше следующих
+            await asyncio.sleep(0.05 if message.text == "0" else 0.001)
+            events.append(("end", message.chat.id, message.text))
+
+        updates = [make_update(i, chat_id, str(i // 2)) for i, chat_id in enumerate([1, 2] * 4)]
+        await asyncio.gather(*(dp.updates_handler.notify(update) for update in updates))
+        return serializer.chats
+
+    assert run(scenario) == {}
+    for chat_id in (1, 2):
+        chat_events = [(kind, text) for kind, chat, text in events if chat == chat_id]
+        assert chat_events == [(kind, str(i)) for i in range(4) for kind in ("start", "end")]
+    # чаты обрабатываются параллельно: второй начал до того, как первый закончил
+    assert events.index(("start", 2, "0")) < events.index(("end", 1, "0"))
+
+
+@pytest.mark.parametrize("error", [CancelHandler(), RuntimeError("middleware failed")])
+def test_lock_is_released_when_later_middleware_fails(error):
+    handled = []
+
+    class Failing(BaseMiddleware):
+        async def on_pre_process_update(self, update, data):
+            if update.update_id == 0:
+                raise error
+
+    async def scenario(dp, serializer):
+        dp.middleware.setup(Failing())
+
+        @dp.message_handler()
+        async def handler(message):
+            handled.append(message.text)
+
+        try:
+            await dp.updates_handler.notify(make_update(0, 1, "first"))
+        except RuntimeError:
+            pass
+        await asyncio.wait_for(dp.updates_handler.notify(make_update(1, 1, "second")), 1)
+        return serializer.chats
+
+    assert run(scenario) == {}
+    assert handled == ["second"]
@@ -0,0 +1,73 @@
+import pytest
+
+from tech import exchange_rates_api
+from tech.exchange_rates_api import set_rate_provider
+from tech.money import Money
+
+CHAT = 100
+
+
+async def debts(db):
+    return [(debtor_id, creditor_id, amount, currency) for _, debtor_id, creditor_id, amount, currency, _ in await db.get_debts_from_chat(CHAT)]
+
+
+def test_new_pairs_are_inserted(run_with_db):
+    async def scenario(db):
+        await db.apply_expense_split(1, {1: Money(500, "USD"), 2: Money(500, "USD"), 3: Money(500, "USD")}, "USD", "x", CHAT)
+        return await debts(db)
+
+    # свою долю плательщик себе не должен
+    assert sorted(run_with_db(scenario)) == [(2, 1, 500, "USD"), (3, 1, 500, "USD")]
+
+
+def test_same_direction_accumulates(run_with_db):
+    async def scenario(db):
+        await db.apply_expense_split(1, {2: Money(500, "USD")}, "USD", "x", CHAT)
+        await db.apply_expense_split(1, {2: Money(250, "USD")}, "USD", "y", CHAT)
+        return await debts(db)
+
+    assert run_with_db(scenario) == [(2, 1, 750, "USD")]
+
+
+@pytest.mark.parametrize("amount, expected", [
+    (300, [(2, 1, 200, "USD")]),
+    (500, []),
+    (800, [(1, 2, 300, "USD")]),
+])
+def test_opposite_direction_nets(run_with_db, amount, expected):
+    async def scenario(db):
+        await db.apply_expense_split(1, {2: Money(500, "USD")}, "USD", "x", CHAT)
+        await db.apply_expense_split(2, {1: Money(amount, "USD")}, "USD", "y", CHAT)
+        return await debts(db)
+
+    assert run_with_db(scenario) == expected
+
+
+def test_different_currency_nets_in_existing_currency(run_with_db, offline_rates):
+    async def scenario(db):
+        await db.apply_expense_split(1, {2: Money(1000, "EUR")}, "EUR", "x", CHAT)
+        # 10 USD по последнему известному курсу 0.95 = 9.50 EUR в обратную сторону
+        await db.apply_expense_split(2, {1: Money(1000, "USD")}, "USD", "y", CHAT)
+        return await debts(db)
+
+    assert run_with_db(scenario) == [(2, 1, 50, "EUR")]
+
+
+def test_missing_rate_raises_and_writes_nothing(run_with_db, monkeypatch):
+    class Offline():
+        def get_daily_rates(self, currencies, start, end):
+            raise ConnectionError("offline")
+
+    monkeypatch.setattr(exchange_rates_api, "rate_provider", exchange_rates_api.rate_provider)
+    monkeypatch.setattr(exchange_rates_api.rates_cache, "pool", None)
+    exchange_rates_api.rates_cache.memory.clear()
+    set_rate_provider(Offline())
+
+    async def scenario(db):
+        await db.apply_expense_split(1, {2: Money(1000, "EUR")}, "EUR", "x", CHAT)
+        with pytest.raises(ValueError):
+            await db.apply_expense_split(2, {1: Money(1000, "USD"), 3: Money(1000, "USD")}, "USD", "y", CHAT)
+        return await debts(db), await db.get_ledger_version(CHAT)
+
+    # вся трата откатилась, включая долю участника без встречного долга
+    assert run_with_db(scenario) == ([(2, 1, 1000, "EUR")], 1)
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from tech.fsm_storage import SQLiteStorage
+
+CHAT, USER = 100, 1
+
+
+async def row_count(db):
+    return (await db.pool.run(lambda connection: connection.execute("SELECT COUNT(*) FROM fsm_states").fetchone()))[0]
+
+
+def test_expired_row_is_hidden(run_with_db):
+    async def scenario(db):
+        storage = SQLiteStorage(db.pool, ttl=60)
+        await storage.set_state(chat=CHAT, user=USER, state="old")
+        await storage.set_data(chat=CHAT, user=USER, data={"key": "old"})
+        await db.pool.run(lambda connection: connection.execute("UPDATE fsm_states SET updated_at = updated_at - 120"))
+        expired = (await storage.get_state(chat=CHAT, user=USER), await storage.get_data(chat=CHAT, user=USER))
+        # запись одной колонки не воскрешает просроченные соседние
+        await storage.set_data(chat=CHAT, user=USER, data={"key": "new"})
+        return expired, await storage.get_state(chat=CHAT, user=USER), await storage.get_data(chat=CHAT, user=USER)
+
+    assert run_with_db(scenario) == ((None, {}), None, {"key": "new"})
+
+
+def test_purge_deletes_expired_rows(run_with_db):
+    async def scenario(db):
+        storage = SQLiteStorage(db.pool, ttl=60)
+        await storage.set_state(chat=CHAT, user=USER, state="old")
+        await storage.set_state(chat=CHAT, user=USER + 1, state="fresh")
+        await db.pool.run(lambda connection: connection.execute("UPDATE fsm_states SET updated_at = updated_at - 120 WHERE user_id = ?", (USER,)))
+        return await storage.purge_expired(), await row_count(db)
+
+    assert run_with_db(scenario) == (1, 1)
+
+
+def test_concurrent_update_data_keeps_keys(run_with_db):
+    async def scenario(db):
+        storage = SQLiteStorage(db.pool)
+        await asyncio.gather(*(storage.update_data(chat=CHAT, user=USER, **{f"key{i}": i}) for i in range(20)))
+        return await storage.get_data(chat=CHAT, user=USER)
+
+    assert run_with_db(scenario) == {f"key{i}": i for i in range(20)}
+
+
+def test_payload_size_limit(run_with_db):
+    async def scenario(db):
+        storage = SQLiteStorage(db.pool, max_payload_size=64)
+        await storage.set_data(chat=CHAT, user=USER, data={"key": "small"})
+        with pytest.raises(ValueError):
+            await storage.update_data(chat=CHAT, user=USER, key="x" * 100)
+        with pytest.raises(ValueError):
+            await storage.set_bucket(chat=CHAT, user=USER, bucket={"key": "x" * 100})
+        return await storage.get_data(chat=CHAT, user=USER), await storage.get_bucket(chat=CHAT, user=USER)
+
+    # слишком большие данные не записываются, прежние остаются
+    assert run_with_db(scenario) == ({"key": "small"}, {})
+
+
+def test_finish_deletes_empty_row(run_with_db):
+    async def scenario(db):
+        storage = SQLiteStorage(db.pool)
+        await storage.set_state(chat=CHAT, user=USER, state="waiting")
+        await storage.update_data(chat=CHAT, user=USER, key="value")
+        before = await row_count(db)
+        await storage.finish(chat=CHAT, user=USER)
+        return before, await row_count(db), await storage.get_state(chat=CHAT, user=USER)
+
+    assert run_with_db(scenario) == (1, 0, None)
@@ -0,0 +1,76 @@
+import sqlite3
+
+import pytest
+
+from tech.database import Database
+from tech.ledger import EXPENSE, PAYMENT, append_events, apply_events, replay
+from tech.money import Money
+
+CHAT = 100
+
+
+@pytest.mark.parametrize("creditor_id, debtor_id, expected", [
+    # сумма > 0 - меньший id должен большему
+    (2, 1, {(1, 2, "USD"): 500}),
+    (1, 2, {(1, 2, "USD"): -500}),
+])
+def test_expense_sign(creditor_id, debtor_id, expected):
+    assert apply_events({}, [(EXPENSE, creditor_id, debtor_id, 500, "USD")]) == expected
+
+
+@pytest.mark.parametrize("creditor_id, debtor_id", [(2, 1), (1, 2)])
+def test_payment_cancels_expense(creditor_id, debtor_id):
+    state = apply_events({}, [
+        (EXPENSE, creditor_id, debtor_id, 500, "USD"),
+        (PAYMENT, creditor_id, debtor_id, 200, "USD"),
+    ])
+    assert state == apply_events({}, [(EXPENSE, creditor_id, debtor_id, 300, "USD")])
+    apply_events(state, [(PAYMENT, creditor_id, debtor_id, 300, "USD")])
+    assert state == {(1, 2, "USD"): 0}
+
+
+def test_currencies_are_not_netted():
+    state = apply_events({}, [(EXPENSE, 1, 2, 500, "USD"), (EXPENSE, 2, 1, 300, "EUR")])
+    assert state == {(1, 2, "USD"): -500, (1, 2, "EUR"): 300}
+
+
+def events(count, start=0):
+    return [(CHAT, EXPENSE if i % 3 else PAYMENT, 1 + i % 2, 2 - i % 2, 100 + i, "USD", None, "2024-01-01") for i in range(start, start + count)]
+
+
+def expected_state(rows):
+    return apply_events({}, (row[1:6] for row in rows))
+
+
+def test_replay_from_snapshot_and_tail(tmp_path):
+    path = str(tmp_path / "ledger.db")
+    Database(path).migrate()
+    connection = sqlite3.connect(path, isolation_level=None)
+    append_events(connection, events(5))
+
+    full_state, version = replay(connection, CHAT, snapshot_interval=5)
+    assert version == 5
+    assert connection.execute("SELECT chat_id, event_id FROM ledger_snapshots").fetchall() == [(CHAT, 5)]
+
+    append_events(connection, events(3, start=5))
+    # события до снимка больше не читаются: их удаление не меняет результат
+    connection.execute("DELETE FROM ledger WHERE event_id <= 5")
+    state, version = replay(connection, CHAT, snapshot_interval=5)
+    assert version == 8
+    # хвост короче интервала - новый снимок не пишется
+    assert connection.execute("SELECT COUNT(*) FROM ledger_snapshots").fetchone()[0] == 1
+
+    assert full_state == expected_state(events(5))
+    assert state == expected_state(events(8))
+
+
+def test_replay_ledger_matches_debts(run_with_db):
+    async def scenario(db):
+        await db.apply_expense_split(1, {2: Money(500, "USD"), 3: Money(300, "USD")}, "USD", "x", CHAT)
+        await db.apply_expense_split(2, {1: Money(200, "USD")}, "USD", "y", CHAT)
+        await db.record_payment(3, 1, Money(100, "USD"), CHAT)
+        return await db.replay_ledger(CHAT)
+
+    state, version = run_with_db(scenario)
+    assert version == 4
+    assert {key: amount for key, amount in state.items() if amount} == {(1, 2, "USD"): -300, (1, 3, "USD"): -200}
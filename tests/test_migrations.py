@@ -0,0 +1,147 @@
+import sqlite3
+
+import pytest
+
+from tech import database
+from tech.database import MIGRATIONS, Database, _create_tables, get_schema_version
+
+LATEST = MIGRATIONS[-1][0]
+
+# (creditor_id, debtor_id, amount, currency, chat_id) в базовой схеме - суммы в REAL
+BASELINE_DEBTS = [
+    (1, 2, 10.5, "USD", 100),
+    (1, 3, 0.1, "USD", 100),
+    (3, 2, 7.25, "EUR", 100),
+    (4, 5, 99.99, "RUB", 200),
+]
+
+
+def columns(connection, table):
+    return {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+
+
+def make_baseline(path):
+    connection = sqlite3.connect(path)
+    _create_tables(connection.cursor())
+    connection.executemany("INSERT INTO chats (chat_id) VALUES (?)", [(100,), (200,)])
+    connection.executemany(
+        "INSERT INTO debts (creditor_id, debtor_id, amount, currency, description, date, chat_id) VALUES (?, ?, ?, ?, 'x', '2024-01-01', ?)",
+        BASELINE_DEBTS
+    )
+    connection.execute(
+        "INSERT INTO transactions (creditor_id, debtor_id, amount_paid, currency, date, chat_id) VALUES (1, 2, 3.3, 'USD', '2024-01-02', 100)"
+    )
+    connection.commit()
+    connection.close()
+
+
+def assert_migrated(connection):
+    assert get_schema_version(connection) == LATEST
+    assert connection.execute("SELECT COUNT(*) FROM schema_version WHERE NOT backfill_done").fetchone()[0] == 0
+    assert "amount_minor" in columns(connection, "debts") and "amount" not in columns(connection, "debts")
+    assert "amount_paid_minor" in columns(connection, "transactions")
+    assert "balance_minor" in columns(connection, "balances") and "balance" not in columns(connection, "balances")
+    for table in ("ledger", "fsm_states", "reminders", "exchange_rates"):
+        assert columns(connection, table)
+
+
+def assert_baseline_data(connection):
+    debts = connection.execute("SELECT creditor_id, debtor_id, amount_minor, currency, chat_id FROM debts ORDER BY debt_id").fetchall()
+    assert debts == [(1, 2, 1050, "USD", 100), (1, 3, 10, "USD", 100), (3, 2, 725, "EUR", 100), (4, 5, 9999, "RUB", 200)]
+    assert connection.execute("SELECT amount_paid_minor FROM transactions").fetchall() == [(330,)]
+    ledger = connection.execute("SELECT event_id, kind, amount_minor FROM ledger ORDER BY event_id").fetchall()
+    assert ledger == [(1, "expense", 1050), (2, "expense", 10), (3, "expense", 725), (4, "expense", 9999)]
+    balances = set(connection.execute("SELECT chat_id, user_id, currency, balance_minor FROM balances WHERE balance_minor != 0"))
+    assert balances == {
+        (100, 1, "USD", 1060), (100, 2, "USD", -1050), (100, 3, "USD", -10),
+        (100, 3, "EUR", 725), (100, 2, "EUR", -725),
+        (200, 4, "RUB", 9999), (200, 5, "RUB", -9999),
+    }
+
+
+def test_fresh_database(tmp_path):
+    path = str(tmp_path / "fresh.db")
+    Database(path).migrate()
+    connection = sqlite3.connect(path)
+    assert_migrated(connection)
+    # повторный запуск ничего не меняет
+    Database(path).migrate()
+    assert connection.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0] == len(MIGRATIONS)
+
+
+def test_baseline_database_with_data(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    make_baseline(path)
+    Database(path).migrate()
+    connection = sqlite3.connect(path)
+    assert_migrated(connection)
+    assert_baseline_data(connection)
+
+
+def test_interrupted_backfill_resumes(tmp_path, monkeypatch):
+    path = str(tmp_path / "interrupted.db")
+    make_baseline(path)
+    schema_calls = []
+
+    def add_minor_units(cursor):
+        schema_calls.append(4)
+        database._add_minor_units(cursor)
+
+    def crashing_backfill(connection):
+        # успевает заполнить часть таблиц и падает
+        database.backfill(connection, "debts", "amount, currency", "UPDATE debts SET amount_minor = ? WHERE rowid = ?",
+                          lambda row: (database.Money.parse(row[1], row[2]).minor, row[0]), chunk_size=2)
+        raise RuntimeError("crash")
+
+    def patched(backfill_data):
+        return [(4, add_minor_units, backfill_data) if migration[0] == 4 else migration for migration in MIGRATIONS]
+
+    monkeypatch.setattr(database, "MIGRATIONS", patched(crashing_backfill))
+    with pytest.raises(RuntimeError):
+        Database(path).migrate()
+
+    connection = sqlite3.connect(path)
+    assert get_schema_version(connection) == 3
+    assert connection.execute("SELECT backfill_done FROM schema_version WHERE version = 4").fetchall() == [(0,)]
+    connection.close()
+
+    monkeypatch.setattr(database, "MIGRATIONS", patched(database._backfill_minor_units))
+    Database(path).migrate()
+    # шаг схемы не повторяется, повторяется только бэкфилл
+    assert schema_calls == [4]
+    connection = sqlite3.connect(path)
+    assert_migrated(connection)
+    assert_baseline_data(connection)
+
+
+def test_legacy_schema_version_table(tmp_path):
+    # таблица версий без backfill_done из старых запусков: записанные версии считаются завершенными
+    path = str(tmp_path / "legacy.db")
+    connection = sqlite3.connect(path)
+    _create_tables(connection.cursor())
+    connection.execute("CREATE TABLE schema_version (version INTEGER NOT NULL)")
+    connection.execute("INSERT INTO schema_version (version) VALUES (1)")
+    database._create_indexes(connection.cursor())
+    connection.commit()
+    connection.close()
+
+    Database(path).migrate()
+    assert_migrated(sqlite3.connect(path))
+
+
+def test_minor_units_schema_step_is_idempotent(tmp_path, monkeypatch):
+    # база, где прежний migrate успел добавить колонки v4 и упал в бэкфилле, не записав версию
+    path = str(tmp_path / "partial_v4.db")
+    make_baseline(path)
+    monkeypatch.setattr(database, "MIGRATIONS", [migration for migration in MIGRATIONS if migration[0] <= 3])
+    connection = sqlite3.connect(path, isolation_level=None)
+    database.migrate(connection)
+    database._add_minor_units(connection.cursor())
+    connection.commit()
+    connection.close()
+
+    monkeypatch.undo()
+    Database(path).migrate()
+    connection = sqlite3.connect(path)
+    assert_migrated(connection)
+    assert_baseline_data(connection)
@@ -0,0 +1,60 @@
+from decimal import Decimal
+
+import pytest
+
+from tech.money import Money
+
+
+def test_parse_to_minor_units():
+    assert Money.parse("12.5", "USD").minor == 1250
+    assert Money.parse(7, "EUR").minor == 700
+    assert Money.parse("0.1", "USD") + Money.parse("0.2", "USD") == Money.parse("0.3", "USD")
+
+
+def test_parse_rounds_half_even():
+    assert Money.parse("0.125", "USD").minor == 12
+    assert Money.parse("0.135", "USD").minor == 14
+
+
+@pytest.mark.parametrize("value", ["abc", "", "1,5", "NaN", "Infinity"])
+def test_parse_rejects_garbage(value):
+    with pytest.raises(ValueError):
+        Money.parse(value, "USD")
+
+
+def test_arithmetic_and_ordering():
+    a, b = Money(1000, "USD"), Money(250, "USD")
+    assert a + b == Money(1250, "USD")
+    assert a - b == Money(750, "USD")
+    assert -b == Money(-250, "USD")
+    assert abs(Money(-5, "USD")) == Money(5, "USD")
+    assert b < a and a >= b
+    assert not Money.zero("USD")
+    assert hash(Money(1, "USD")) == hash(Money(1, "USD"))
+
+
+def test_currency_mismatch():
+    with pytest.raises(ValueError):
+        Money(1, "USD") + Money(1, "EUR")
+    with pytest.raises(ValueError):
+        Money(1, "USD") < Money(1, "EUR")
+    assert Money(1, "USD") != Money(1, "EUR")
+
+
+def test_convert():
+    assert Money(1000, "USD").convert(0.9, "EUR") == Money(900, "EUR")
+    assert Money(1000, "USD").convert(1 / 3, "EUR") == Money(333, "EUR")
+
+
+@pytest.mark.parametrize("minor, parts", [(1000, 3), (1, 4), (999, 7), (0, 2)])
+def test_split_is_lossless(minor, parts):
+    shares = Money(minor, "USD").split(parts)
+    assert len(shares) == parts
+    assert sum(share.minor for share in shares) == minor
+    assert max(shares).minor - min(shares).minor <= 1
+
+
+def test_formatting():
+    assert Money(1250, "USD").to_decimal() == Decimal("12.50")
+    assert str(Money(1250, "USD")) == "12.50 USD"
+    assert str(Money(-5, "RUB")) == "-0.05 RUB"
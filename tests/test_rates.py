@@ -0,0 +1,66 @@
+import asyncio
+import datetime
+
+import pytest
+
+from tech import rates_cache
+from tech.exchange_rates_api import get_exchange_rate, get_exchange_rates
+from tech.rate_providers import RateProvider, lookup_rates
+from tech.rates_cache import RatesCache
+
+
+def test_lookup_is_as_of(offline_rates):
+    table = offline_rates.get_daily_rates(["EUR"], None, "2024-01-10")
+    # до первой строки курса нет; в выходные берется последний известный
+    assert lookup_rates(table, "EUR", ["2023-12-31", "2024-01-02", "2024-01-04"]) == [None, 0.92, 0.92]
+    assert lookup_rates(table, "GBP", ["2024-01-02"]) == [None]
+
+
+def test_cross_rates_by_triangulation(offline_rates):
+    rates = asyncio.run(get_exchange_rates([
+        ("USD", "EUR", "2024-01-01"),
+        ("EUR", "USD", "2024-01-02"),
+        ("EUR", "RUB", "2024-01-05 12:00:00"),
+        ("RUB", "RUB", "2024-01-05"),
+        ("USD", "GBP", "2024-01-05"),
+    ]))
+    assert rates[0] == pytest.approx(0.90)
+    assert rates[1] == pytest.approx(1 / 0.92)
+    assert rates[2] == pytest.approx(95 / 0.95)
+    assert rates[3] == 1.0
+    assert rates[4] is None
+
+
+def test_rates_are_cached(offline_rates):
+    asyncio.run(get_exchange_rates([("USD", "EUR", "2024-01-02")]))
+    offline_rates.table.loc[:, "EUR"] = 10.0
+    assert asyncio.run(get_exchange_rates([("USD", "EUR", "2024-01-02")])) == [pytest.approx(0.92)]
+
+
+def test_missing_rate(offline_rates):
+    assert asyncio.run(get_exchange_rates([("USD", "EUR", "2023-06-01")])) == [None]
+    with pytest.raises(ValueError):
+        asyncio.run(get_exchange_rate("USD", "EUR", 10, "2023-06-01"))
+    with pytest.raises(ValueError):
+        asyncio.run(get_exchange_rate("USD", "EUR", 10, "yesterday"))
+
+
+@pytest.mark.parametrize("fetched_at, age, fresh", [
+    # получен после конца дня - постоянный
+    ("2024-01-03 00:00:00", 10 ** 6, True),
+    # получен в течение дня: свежий только в пределах today_ttl, даже когда день прошел
+    ("2024-01-02 23:59:00", 60, True),
+    ("2024-01-02 23:59:00", 10 ** 6, False),
+])
+def test_cached_rate_freshness(monkeypatch, fetched_at, age, fresh):
+    fetched_at = datetime.datetime.fromisoformat(fetched_at).replace(tzinfo=datetime.timezone.utc).timestamp()
+    monkeypatch.setattr(rates_cache.time, "time", lambda: fetched_at + age)
+    assert RatesCache(today_ttl=15 * 60)._is_fresh("2024-01-02", fetched_at) == fresh
+
+
+def test_provider_must_implement_daily_rates():
+    class Incomplete(RateProvider):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
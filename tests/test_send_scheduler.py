@@ -0,0 +1,90 @@
+import asyncio
+import random
+import time
+
+from aiogram.utils.exceptions import RetryAfter
+
+from tech.send_scheduler import SendScheduler
+
+
+class FakeBot():
+    # запоминает отправленные сообщения; fail_first: {chat_id: исключение для первой попытки}
+    def __init__(self, fail_first=None, delay=0):
+        self.fail_first = dict(fail_first or {})
+        self.delay = delay
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(random.uniform(0, self.delay))
+        error = self.fail_first.pop(chat_id, None)
+        if error is not None:
+            raise error
+        self.sent.append((time.monotonic(), chat_id, text))
+        return len(self.sent)
+
+
+def run(bot, scenario):
+    async def main():
+        scheduler = SendScheduler(bot, global_rate=1000, private_rate=1000, group_rate=1000)
+        scheduler.start()
+        try:
+            return await scenario(scheduler)
+        finally:
+            await scheduler.stop()
+    return asyncio.run(main())
+
+
+def test_pending_messages_are_coalesced():
+    bot = FakeBot()
+
+    async def scenario(scheduler):
+        futures = [scheduler.enqueue(1, text) for text in ("a", "b", "c")]
+        # другие параметры отправки - отдельное сообщение
+        futures.append(scheduler.enqueue(1, "d", reply_to_message_id=5))
+        return await asyncio.gather(*futures), scheduler.stats()
+
+    results, stats = run(bot, scenario)
+    assert [text for _, _, text in bot.sent] == ["a\n\nb\n\nc", "d"]
+    assert results == [1, 1, 1, 2]
+    assert stats["coalesced"] == 2 and stats["sent"] == 2
+
+
+def test_retry_after_pauses_and_requeues():
+    bot = FakeBot(fail_first={1: RetryAfter(0.2)})
+
+    async def scenario(scheduler):
+        start = time.monotonic()
+        first = scheduler.enqueue(1, "first", reply_to_message_id=1)
+        second = scheduler.enqueue(1, "second", reply_to_message_id=2)
+        # сообщение в другой чат во время паузы тоже ждет ее конца
+        await asyncio.sleep(0.05)
+        other = scheduler.enqueue(2, "other")
+        await asyncio.gather(first, second, other)
+        return start, scheduler.stats()
+
+    start, stats = run(bot, scenario)
+    by_chat = {}
+    for sent_at, chat_id, text in bot.sent:
+        by_chat.setdefault(chat_id, []).append(text)
+        assert sent_at - start >= 0.2
+    # сообщение вернулось в начало очереди своего чата
+    assert by_chat == {1: ["first", "second"], 2: ["other"]}
+    assert stats["retries"] == 1 and stats["failed"] == 0
+
+
+def test_per_chat_order_is_kept():
+    bot = FakeBot(delay=0.005)
+    chats = [1, 2, -3]
+
+    async def scenario(scheduler):
+        futures = []
+        for i in range(10):
+            for chat_id in chats:
+                # разные reply_to_message_id, чтобы сообщения не склеились
+                futures.append(scheduler.enqueue(chat_id, str(i), reply_to_message_id=i))
+            await asyncio.sleep(random.uniform(0, 0.002))
+        await asyncio.gather(*futures)
+
+    run(bot, scenario)
+    for chat_id in chats:
+        assert [text for _, chat, text in bot.sent if chat == chat_id] == [str(i) for i in range(10)]
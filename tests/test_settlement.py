@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+from tech.settlement import EXACT_MAX_MEMBERS, net_balances, settle, settle_exact, settle_greedy, sum_balances
+
+
+def apply_transfers(balances, transfers):
+    result = dict(balances)
+    for debtor_id, creditor_id, amount in transfers:
+        assert amount > 0
+        result[debtor_id] += amount
+        result[creditor_id] -= amount
+    return {user_id: balance for user_id, balance in result.items() if balance}
+
+
+def random_balances(members, seed):
+    rng = random.Random(seed)
+    debts = [(*rng.sample(range(members), 2), rng.randint(1, 10000)) for _ in range(members * 3)]
+    return net_balances(debts)
+
+
+def test_net_balances():
+    debts = [(1, 2, 500), (2, 3, 200), (3, 1, 100)]
+    assert net_balances(debts) == {1: -400, 2: 300, 3: 100}
+
+
+def test_sum_balances_drops_zero():
+    assert sum_balances([(1, 100), (2, -50), (1, -100)]) == {2: -50}
+
+
+@pytest.mark.parametrize("settle_fn", [settle_greedy, settle_exact])
+def test_empty(settle_fn):
+    assert settle_fn({}) == []
+
+
+@pytest.mark.parametrize("members", [2, 5, 10, 200])
+def test_greedy_settles_everything(members):
+    balances = random_balances(members, members)
+    transfers = settle_greedy(balances)
+    assert apply_transfers(balances, transfers) == {}
+    assert len(transfers) <= len(balances) - 1
+
+
+@pytest.mark.parametrize("members", [2, 5, 8, 12])
+def test_exact_settles_everything_and_beats_greedy(members):
+    balances = random_balances(members, members)
+    transfers = settle_exact(balances)
+    assert apply_transfers(balances, transfers) == {}
+    assert len(transfers) <= len(settle_greedy(balances))
+
+
+def test_exact_uses_zero_sum_groups():
+    # жадно: 4 перевода; группы {2, 5} и {1, 3, 4} гасятся за 1 + 2
+    balances = {1: 400, 2: 300, 3: -200, 4: -200, 5: -300}
+    assert len(settle_greedy(balances)) == 4
+    transfers = settle_exact(balances)
+    assert len(transfers) == 3
+    assert apply_transfers(balances, transfers) == {}
+
+
+def test_exact_rejects_large_groups():
+    balances = {user_id: 1 for user_id in range(EXACT_MAX_MEMBERS)}
+    balances[EXACT_MAX_MEMBERS] = -EXACT_MAX_MEMBERS
+    with pytest.raises(ValueError):
+        settle_exact(balances)
+
+
+def test_settle_picks_mode_by_size():
+    small = {1: 400, 2: 300, 3: -200, 4: -200, 5: -300}
+    assert len(settle(small)) == 3
+    assert len(settle(small, exact=False)) == 4
+
+    large = random_balances(EXACT_MAX_MEMBERS * 4, 0)
+    assert apply_transfers(large, settle(large)) == {}
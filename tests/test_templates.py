@@ -0,0 +1,63 @@
+import string
+
+import pytest
+from aiogram.utils import markdown as md
+
+from tech import texts
+from tech.templates import FALLBACK_LANG, Template, Text, escape
+
+NASTY = "a_b*c[d](e)~f`g>h#i+j-k=l|m{n}o.p!q\\r"
+
+
+def all_texts():
+    for name in dir(texts):
+        value = getattr(texts, name)
+        if isinstance(value, Text):
+            for lang, text in value.items():
+                yield name, lang, text
+
+
+def test_escape_matches_escape_md():
+    everything = "".join(chr(code) for code in range(512))
+    assert escape(everything) == md.escape_md(everything)
+
+
+@pytest.mark.parametrize("name, lang, text", list(all_texts()))
+def test_render_matches_escape_md(name, lang, text):
+    fields = sum(1 for _, field, _, _ in string.Formatter().parse(text) if field is not None)
+    args = [f"{NASTY}{i}" for i in range(fields)]
+    assert getattr(texts, name).render(lang, *args) == md.escape_md(text.format(*args))
+
+
+def test_template_fields():
+    assert Template("{} and {}").render("x.", "y") == "x\\. and y"
+    assert Template("{1} and {0}").render("x.", "y") == "y and x\\."
+    assert Template("{name}: {value:.2f}!").render(name="a_b", value=1.5) == "a\\_b: 1\\.50\\!"
+    assert Template("{!r}").render("a") == "'a'"
+
+
+@pytest.mark.parametrize("text", ["{} and {0}", "{0} and {}"])
+def test_mixed_numbering_is_rejected(text):
+    with pytest.raises(ValueError):
+        text.format("x", "y")
+    with pytest.raises(ValueError):
+        Template(text)
+
+
+def test_static_template_is_prerendered():
+    template = Template("Hello, world!")
+    assert template.static == "Hello, world\\!"
+    assert template.render() == template.static
+
+
+def test_fallback_language():
+    text = Text({FALLBACK_LANG: "Hi {}!", "ru": "Привет {}!"})
+    assert text.render("ru", "x") == "Привет x\\!"
+    assert text.render("de", "x") == "Hi x\\!"
+    # сам словарь не меняется: сырые строки нужны для кнопок
+    assert text["ru"] == "Привет {}!"
+
+
+def test_every_text_has_fallback():
+    for name, lang, text in all_texts():
+        assert FALLBACK_LANG in getattr(texts, name), name